@@ -0,0 +1,66 @@
+"""
+Copyright 2019 Jeff Klesky
+
+Redistribution and use in source and binary forms, with or without modification,
+are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright
+   notice, this list of conditions and the following disclaimer in the
+   documentation and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+"AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import argparse
+
+from flentsqm.simulate import STRATEGIES, TEST_FLOWS, benchmark
+from flentsqm.stats import SeriesStats
+
+parser = argparse.ArgumentParser(description="Compare SQM search strategies on simulated devices")
+parser.add_argument("--devices", type=int, default=50, help="simulated devices per strategy")
+parser.add_argument("--test", default="tcp_8down", choices=sorted(TEST_FLOWS))
+parser.add_argument("--strategy", action="append", choices=STRATEGIES,
+                    help="strategy to run, repeatable (default all)")
+parser.add_argument("--seed", type=int, default=1)
+parser.add_argument("--verbose", action="store_true", help="one line per simulated device")
+args = parser.parse_args()
+
+results = benchmark(strategies=args.strategy, devices=args.devices, test=args.test, seed=args.seed)
+
+print(f"{args.devices} simulated devices, {args.test}, seed {args.seed}")
+print()
+print(f"{'Strategy':<20s} {'runs mean':>9s} {'median':>6s} {'max':>4s} {'hours':>6s}"
+      f" {'|error| med':>11s} {'bias':>7s} {'within 5%':>9s} {'missed':>6s}")
+
+for strategy, outcomes in results.items():
+    runs = SeriesStats([o["runs"] for o in outcomes])
+    hours = SeriesStats([o["elapsed"] / 3600 for o in outcomes])
+    errors = [o["error"] for o in outcomes if o["error"] is not None]
+    abs_errors = SeriesStats([abs(e) for e in errors])
+    bias = SeriesStats(errors)
+    within = len([e for e in errors if abs(e) <= 0.05])
+    missed = len(outcomes) - len(errors)
+    print(f"{strategy:<20s} {runs.mean:9.1f} {runs.median:6.0f} {runs.max:4.0f} {hours.mean:6.2f}"
+          f" {abs_errors.median * 100 if errors else float('nan'):10.1f}%"
+          f" {bias.mean * 100 if errors else float('nan'):6.1f}%"
+          f" {within / len(outcomes) * 100:8.0f}% {missed:6d}")
+
+    if args.verbose:
+        for o in outcomes:
+            selected = f"{o['selected']:8.1f}" if o["selected"] else "    None"
+            error = f"{o['error'] * 100:6.1f}%" if o["error"] is not None else "       "
+            print(f"    {o['device']!r:<50s} boundary {o['boundary']:8.1f} selected {selected}"
+                  f" {error} {o['runs']:3d} runs")
@@ -26,10 +26,20 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import math
 import sys
-
-from flentsqm.runs import RunCollector, FlentRun, execute_one_test
-from flentsqm.router import Router
+import time
+
+from flentsqm.health import TestbedUnhealthy, preflight
+from flentsqm.monitor import RunMonitor
+from flentsqm.resources import RouterSampler
+from flentsqm.settle import Settler
+from flentsqm.runs import RunCollector, FlentRun, execute_one_test, split_target, make_target
+from flentsqm.router import Router, ifb_name
 from flentsqm.naming import protect_for_filename
+from flentsqm.stats import relative_interval_width, sprt_bounds, sprt_llr
+from flentsqm.timing import span
+
+# flent host by tunnel name, "None" for no tunnel, where a testbed does not give its own
+DEFAULT_HOSTS = {"None": "10.0.0.2", "WireGuard": "172.16.0.2", "OpenVPN": "172.16.1.2"}
 
 ###
 ### TODO: Handle failed flent run (more than logging error?)
@@ -69,25 +79,129 @@ from flentsqm.naming import protect_for_filename
 
 class PassController:
 
-    def _default_test_run_successful(self, run: FlentRun):
-        var_ok = (run.coefvar_both < 0.01) or (run.stddev_both < 0.02)
+    def _default_test_run_successful(self, run: FlentRun, directions=("download", "upload")):
+        # Only the given directions' flows and rates count, for searching one of them
+        if run.truncated or run.invalid:
+            return False
+        download_target, upload_target = split_target(self.current_target)
+        if download_target == upload_target and len(directions) == 2:
+            if run.coefvar_both is None or run.stddev_both is None:
+                return False
+            var_ok = (run.coefvar_both < self.coefvar_limit) or (run.stddev_both < self.stddev_limit)
+        else:
+            # Flows shaped to different rates differ by design, so judge each direction's flows alone
+            flow_stats = [(run.coefvar_download, run.stddev_download) if direction == "download"
+                          else (run.coefvar_upload, run.stddev_upload) for direction in directions]
+            flow_stats = [(coefvar, stddev) for coefvar, stddev in flow_stats if coefvar is not None]
+            if not flow_stats or any(stddev is None for coefvar, stddev in flow_stats):
+                return False
+            var_ok = all((coefvar < self.coefvar_limit) or (stddev < self.stddev_limit)
+                         for coefvar, stddev in flow_stats)
         ###
         ### TODO: Handle misbehaving SQM better?
         ###
-        sqm_fudge_factor = 0.7
-        if self.current_target:
-            if run.download and run.download < self.current_target * sqm_fudge_factor:
+        sqm_fudge_factor = self.sqm_fudge_factor
+        if "download" in directions and download_target:
+            if run.download and run.download < download_target * sqm_fudge_factor:
                 return False
-            if run.upload and run.upload < self.current_target * sqm_fudge_factor:
+        if "upload" in directions and upload_target:
+            if run.upload and run.upload < upload_target * sqm_fudge_factor:
                 return False
+        # Throughput over time, only for runs with per-sample data
+        if self.series_coefvar_limit:
+            for direction in directions:
+                coefvar = run.coefvar_download_series if direction == "download" else run.coefvar_upload_series
+                if coefvar is not None and coefvar >= self.series_coefvar_limit:
+                    return False
+        # Only for runs with router samples
+        if (self.cpu_headroom_limit is not None and run.resources is not None
+                and run.resources.cpu_headroom is not None and run.resources.cpu_headroom < self.cpu_headroom_limit):
+            return False
+        # Latency gates only apply when the run has per-sample data
+        if self.latency_p99_limit and run.latency_p99 is not None and run.latency_p99 >= self.latency_p99_limit:
+            return False
+        if (self.latency_increase_limit and run.latency_increase is not None
+                and run.latency_increase >= self.latency_increase_limit):
+            return False
         if self.ping_limit:
-            return var_ok and run.ping < self.ping_limit
+            return var_ok and run.ping is not None and run.ping < self.ping_limit
         else:
             return var_ok
 
     def _default_test_run_no_progress(self, run: FlentRun):
         return False
 
+    def _default_run_margin(self, run: FlentRun):
+        # Relative distance of a run from the nearest pass/fail threshold of
+        # _default_test_run_successful(); negative when on the failing side.
+        # Each is scaled so a run as good as it can be is about 1, so strong is reachable
+        if run.truncated:
+            return -1  # Only ever stopped when clearly failing
+        margins = []
+        if run.coefvar_both is not None and run.stddev_both is not None:
+            margins.append(max((self.coefvar_limit - run.coefvar_both) / self.coefvar_limit,
+                               (self.stddev_limit - run.stddev_both) / self.stddev_limit))
+        for throughput, target in zip((run.download, run.upload), split_target(self.current_target)):
+            if throughput and target:
+                # 0 at the fudge-factor floor, 1 where the shaper delivers all of the target
+                floor = target * self.sqm_fudge_factor
+                margins.append((throughput - floor) / (target - floor))
+        if self.series_coefvar_limit:
+            for coefvar in (run.coefvar_download_series, run.coefvar_upload_series):
+                if coefvar is not None:
+                    margins.append((self.series_coefvar_limit - coefvar) / self.series_coefvar_limit)
+        if self.ping_limit and run.ping is not None:
+            margins.append((self.ping_limit - run.ping) / self.ping_limit)
+        if self.latency_p99_limit and run.latency_p99 is not None:
+            margins.append((self.latency_p99_limit - run.latency_p99) / self.latency_p99_limit)
+        if self.latency_increase_limit and run.latency_increase is not None:
+            margins.append((self.latency_increase_limit - run.latency_increase) / self.latency_increase_limit)
+        if self.cpu_headroom_limit and run.resources is not None and run.resources.cpu_headroom is not None:
+            margins.append((run.resources.cpu_headroom - self.cpu_headroom_limit) / self.cpu_headroom_limit)
+        if not margins:
+            return 0
+        return min(margins)
+
+    def _default_decide_target(self, results):
+        count_successes = len([ok for run, ok in results if ok])
+        count_failures = len(results) - count_successes
+        if count_successes >= self.target_success_requires:
+            return True
+        if count_failures >= self.target_failure_requires:
+            return False
+        return None
+
+    def _sequential_decide_target(self, results):
+        # Wald's SPRT on run outcomes, with each run weighted by how far it
+        # landed from the thresholds. Clear results decide in one run;
+        # borderline ones keep sampling, up to sequential_max_runs.
+        upper, lower = sprt_bounds(self.sequential_alpha, self.sequential_beta)
+        llr = 0
+        for run, ok in results:
+            margin = self.run_margin(run)
+            if (margin >= 0) != ok:
+                weight = 1
+            elif abs(margin) >= self.sequential_strong_margin:
+                weight = 2
+            elif abs(margin) < self.sequential_weak_margin:
+                weight = 0.5
+            else:
+                weight = 1
+            llr += weight * sprt_llr(ok, self.sequential_p_good, self.sequential_p_bad)
+        if llr >= upper:
+            return True
+        if llr <= lower:
+            return False
+        if len(results) >= self.sequential_max_runs:
+            return llr >= 0
+        return None
+
+    def use_sequential_decision(self, alpha=0.05, beta=0.05, max_runs=5):
+        self.sequential_alpha = alpha
+        self.sequential_beta = beta
+        self.sequential_max_runs = max_runs
+        self.decide_target = self._sequential_decide_target
+
     def _default_create_sqm_string(self, sqm):
         if sqm and sqm >= self.sqm_fractional_threshold:
             sqmf = f"{sqm}"
@@ -98,28 +212,69 @@ class PassController:
         return sqmf
 
     def _default_create_title(self):
-        sqmf = self.create_sqm_string(self.current_target)
-        return protect_for_filename(f"{self.device}_{self.tunnel}_SQM_{sqmf}_{sqmf}")
+        downf, upf = (self.create_sqm_string(target) for target in split_target(self.current_target))
+        return protect_for_filename(f"{self.device}_{self.tunnel}_SQM_{downf}_{upf}")
 
     def _default_create_note(self):
-        sqmf = self.create_sqm_string(self.current_target)
-        return f"{self.device} {self.tunnel} {self.test} {sqmf}/{sqmf}"
+        downf, upf = (self.create_sqm_string(target) for target in split_target(self.current_target))
+        return f"{self.device} {self.tunnel} {self.test} {downf}/{upf}"
 
     def _default_prepare_sqm(self):
-        self.router.sqm_set_params(interface=self.iface, overhead=self.overhead)
-        self.router.sqm_enable(yes=(self.current_target is not None), print_output=True)
+        # Disabled SQM ignores interface and overhead, so leave them for the next shaped pass
+        if self.current_target is None:
+            self.router.apply({"enabled": 0}, restart=True, print_output=True)
+            return
+        self.router.apply({"interface": self.iface,
+                           "overhead": self.overhead,
+                           "enabled": 1},
+                          restart=True, print_output=True)
+
+    def _default_preflight(self):
+        # Shaped runs also need the SQM qdiscs in place
+        return preflight(self.router, self.host, iface=self.iface if self.current_target is not None else None,
+                         netperf=self.preflight_netperf)
 
     def _default_after_run(self, run):
         print(run.flent_output_string)
 
     def _default_dump(self):
-        print(self.collected.dump(with_output_filename=False))
-        if self.logname:
-            with open(self.logname, mode='w') as logfile:
-                print(self.collected.dump(), file=logfile)
+        # Only the runs since the last call, so each run costs one row rather than a full rewrite
+        with span("dump", "dump"):
+            if self.logname:
+                print(self.collected.append_log(self.logname), end='')
+            else:
+                print(''.join(self.collected.dump_one(run, with_output_filename=False)
+                              for run in self.collected.runs[self._dumped:]), end='')
+        self._dumped = len(self.collected.runs)
+
+    def _default_dump_summary(self):
+        with span("dump summary", "dump"):
+            print(self.collected.dump(sort=self.summary_sort, with_output_filename=False))
+            if self.logname:
+                self.collected.write_log(self.logname, sort=self.summary_sort)
+
+    def _default_record_state(self):
+        # Lets a sweep resumed from the journal skip or replay this pass
+        journal = self.collected.journal
+        if journal is None:
+            return
+        with span("record state", "journal"):
+            self.collected.checkpoint()
+            if self.name:
+                journal.record_state(self.collected.journal_key, self.name,
+                                     {"target": self.current_target,
+                                      "calibrating": self.calibrating,
+                                      "runs_executed": self.runs_executed,
+                                      "complete": self.pass_complete})
 
     def _default_before_continue(self):
         self._default_dump()
+        self.record_state()
+
+    def _default_after_pass(self):
+        self.pass_complete = True
+        self._default_dump_summary()
+        self.record_state()
 
     def __init__(self, run_collector: RunCollector, router: Router, device, test, tunnel, destdir, logname):
         self.collected = run_collector
@@ -135,18 +290,34 @@ class PassController:
         self.overhead = None
 
         self.ping_limit = None
+        self.latency_p99_limit = None
+        self.latency_increase_limit = None
+        self.coefvar_limit = 0.01
+        self.stddev_limit = 0.02
+        self.series_coefvar_limit = 0.1  # CoV of the summed throughput samples over the test
+        self.sqm_fudge_factor = 0.7
 
         self.run_successful_test = self._default_test_run_successful
         self.no_progress_test = self._default_test_run_no_progress
+        self.run_margin = self._default_run_margin
+        self.decide_target = self._default_decide_target
 
         self.create_sqm_string = self._default_create_sqm_string
         self.create_title = self._default_create_title
         self.create_note = self._default_create_note
 
         self.prepare_sqm = self._default_prepare_sqm
+        self.execute_test = execute_one_test
+        self.preflight = self._default_preflight
         self.after_run = self._default_after_run
         self.before_continue = self._default_before_continue
+        self.record_state = self._default_record_state
+        self.after_pass = self._default_after_pass
 
+        self._dumped = 0
+        self.summary_sort = lambda run: (run.target is None, split_target(run.target), run.timestamp)
+
+        self.name = None
         self.pass_started = False
         self.pass_complete = False
 
@@ -156,11 +327,53 @@ class PassController:
         self.highest_successful_run = None
         self.current_target = None
 
+        self.target_success_requires = 2
+        self.target_failure_requires = 1
+
+        self.sequential_alpha = 0.05
+        self.sequential_beta = 0.05
+        self.sequential_p_good = 0.9
+        self.sequential_p_bad = 0.2
+        self.sequential_strong_margin = 0.5
+        self.sequential_weak_margin = 0.1
+        self.sequential_max_runs = 5
+
+        self.runs_executed = 0
+
+        # Watch each run and stop flent once it has clearly failed
+        self.early_abort = False
+
+        # Attempts at each run, waiting retry_backoff seconds, then twice that, and so on, between
+        # them when the pre-flight check fails or flent gives nothing usable
+        self.run_attempts = 3
+        self.retry_backoff = 10
+        self.preflight_netperf = False
+        self.runs_invalid = 0
+
+        # Sample router CPU, memory and qdisc counters while each run goes
+        self.sample_resources = False
+        self.cpu_headroom_limit = None  # Least idle share of the busiest core, e.g. 0.05
+
+        # Before each run, wait until ping is back near idle and the router CPU is quiet,
+        # up to settle_timeout seconds, rather than starting straight after the last one
+        self.settle = False
+        self.settle_timeout = 30
+        self._settler = None
+
+        # Short flent runs (-l seconds) to find the boundary before full-length runs
+        self.calibration_length = None
+        self.calibrating = False
+
+        # Count earlier runs at the same target in this collector toward the verdict
+        self.reuse_prior_runs = True
+        self.prior_run_max_age = None  # seconds
+        self.runs_reused = 0
+
 
         if self.tunnel is None or self.tunnel.lower() == "none":
             self.tunnel = None
-            self.host = '10.0.0.2'
-            self.iface = router.run_cmd("uci get network.wan.ifname").stdout.decode('utf-8').strip()
+            self.host = DEFAULT_HOSTS["None"]
+            self.iface = router.uci_get("network.wan.ifname")
             if not self.iface:
                 print("No interface for wan returned. Exiting")
                 exit(1)
@@ -168,13 +381,13 @@ class PassController:
 
         elif self.tunnel.lower() == "wireguard":
             self.tunnel = "WireGuard"
-            self.host = "172.16.0.2"
+            self.host = DEFAULT_HOSTS["WireGuard"]
             self.iface = "wg0"
             self.overhead = 82
 
         elif self.tunnel.lower() == "openvpn":
             self.tunnel = "OpenVPN"
-            self.host = "172.16.1.2"
+            self.host = DEFAULT_HOSTS["OpenVPN"]
             self.iface = "tun0"
             self.overhead = 95
 
@@ -182,6 +395,128 @@ class PassController:
             print(f"Unrecognized tunnel: '{tunnel}'. Exiting")
             exit(2)
 
+    def round_target(self, target):
+        if isinstance(target, tuple):
+            return make_target(*(self.round_target(rate) for rate in target))
+        if target < self.sqm_fractional_threshold:
+            target = round(round(target / self.sqm_fractional_increment) * self.sqm_fractional_increment, 1)
+            if target < self.sqm_fractional_threshold:
+                return target
+        # Whole Mbps from the threshold up, also where rounding just below it reached it
+        return int(round(target))
+
+    def create_monitor(self):
+        if not self.early_abort:
+            return None
+        # The interface carries both directions, so only the lower rate is a safe floor
+        target = min(split_target(self.current_target)) if self.current_target is not None else None
+        return RunMonitor(self.router, self.host, self.iface, target=target,
+                          ping_limit=self.ping_limit, sqm_fudge_factor=self.sqm_fudge_factor)
+
+    def create_sampler(self):
+        if not self.sample_resources and self.cpu_headroom_limit is None:
+            return None
+        return RouterSampler(self.router, devices=[self.iface, ifb_name(self.iface)])
+
+    def create_settler(self):
+        if not self.settle:
+            return None
+        if self._settler is None:
+            # Kept for the pass, so the idle baseline only improves; seeded from flent's idle lead-in
+            idle = [run.latency_idle for run in self.collected.runs
+                    if not getattr(run, "invalid", None) and getattr(run, "latency_idle", None) is not None]
+            self._settler = Settler(self.router, self.host, baseline=min(idle) if idle else None)
+        self._settler.timeout = self.settle_timeout
+        return self._settler
+
+    def execute_with_retry(self, **kwargs):
+        # A valid run, or TestbedUnhealthy to give up on the sweep, which the journal lets --resume pick up later
+        reason = None
+        for attempt in range(self.run_attempts):
+            if attempt:
+                delay = self.retry_backoff * 2 ** (attempt - 1)
+                print(f"Retrying in {delay} s ({attempt + 1} of {self.run_attempts})")
+                time.sleep(delay)
+
+            problems = self.preflight() if self.preflight else []
+            if problems:
+                reason = "; ".join(problems)
+                print(f"Pre-flight check failed: {reason}")
+                if self.current_target is not None and any("SQM" in problem for problem in problems):
+                    self.router.invalidate()
+                    self.prepare_sqm()
+                continue
+
+            run = self.execute_test(**kwargs)
+            if not run.invalid:
+                return run
+            reason = run.invalid
+            print(f"Invalid run, not counted: {reason}")
+            self.runs_invalid += 1
+            self.after_run(run)
+            self.collected.add(run)
+
+        self.record_state()
+        raise TestbedUnhealthy(f"Giving up on {self.device} {self.tunnel} {self.test} at {self.current_target}"
+                               f" after {self.run_attempts} attempts: {reason}")
+
+    def evaluate_target(self):
+        with span(f"target {self.current_target}", "target", device=self.device, tunnel=self.tunnel,
+                  test=self.test, target=self.current_target, calibrating=self.calibrating):
+            return self._evaluate_target()
+
+    def _evaluate_target(self):
+        # Repeat runs at current_target until decide_target() reaches a verdict
+        self.pass_started = True
+        results = []
+
+        if self.reuse_prior_runs:
+            prior_runs = self.collected.runs_at(self.current_target, max_age=self.prior_run_max_age,
+                                                full_only=not self.calibrating)
+            for prior_run in prior_runs:
+                results.append((prior_run, self.run_successful_test(prior_run)))
+                decision = self.decide_target(results)
+                if decision is not None:
+                    self.runs_reused += len(results)
+                    print(f"Target {self.current_target} decided from {len(results)} earlier run(s)")
+                    return decision, prior_run
+            self.runs_reused += len(results)
+
+        while True:
+
+            this_run = self.execute_with_retry(router=self.router,
+                                               sqm=self.current_target,
+                                               dest_dir = self.destdir,
+                                               host = self.host,
+                                               test = self.test,
+                                               title = self.create_title(),
+                                               note = self.create_note(),
+                                               monitor = self.create_monitor(),
+                                               length = self.calibration_length if self.calibrating else None,
+                                               sampler = self.create_sampler(),
+                                               settler = self.create_settler(),
+                                               )
+            self.runs_executed += 1
+
+            self.after_run(this_run)
+
+            run_successful = self.run_successful_test(this_run)
+            self.no_progress_test(this_run)
+
+            cr = self.collected.add(this_run)
+
+            if run_successful:
+                cr.marked_good = True
+            else:
+                cr.marked_bad = True
+            results.append((cr, run_successful))
+
+            decision = self.decide_target(results)
+            if decision is not None:
+                return decision, cr
+
+            self.before_continue()
+
     def start(self):
         raise NotImplementedError
 
@@ -201,59 +536,25 @@ class DownPassController(PassController):
 
     def start(self):
         self.current_target = self.start_at
+        self.calibrating = self.calibration_length is not None
         self.prepare_sqm()
 
-        done = False
-        found_success = False
-
-        count_failures = 0
-        count_successes = 0
-
-        while not done:
-
-            this_run = execute_one_test(router=self.router,
-                                        sqm=self.current_target,
-                                        dest_dir = self.destdir,
-                                        host = self.host,
-                                        test = self.test,
-                                        title = self.create_title(),
-                                        note = self.create_note(),
-                                        )
+        while True:
 
-            self.after_run(this_run)
-
-            run_successful = self.run_successful_test(this_run)
-            no_progress = self.no_progress_test(this_run)
-
-            cr = self.collected.add(this_run)
-
-            if run_successful:
-                count_successes += 1
-                cr.marked_good = True
-            else:
-                count_failures += 1
-                cr.marked_bad = True
+            target_successful, cr = self.evaluate_target()
 
-            # Typical condition where additional runs are required
-            if count_successes < self.target_success_requires and count_failures < self.target_failure_requires:
+            # Short runs found the boundary, confirm it with full-length runs
+            if target_successful and self.calibrating:
+                self.calibrating = False
                 self.before_continue()
                 continue
 
             # Success at this SQM target
-            if count_successes >= self.target_success_requires:
-                if not found_success:
-                    found_success = True
-                    cr.marked_selected = True
-                    self.highest_successful_run = self.collected.runs[-1]
-
-            # Failure at this SQM target
-            if count_failures >= self.target_failure_requires:
-                pass  # Well, not really, more below
-
-            if found_success:
-                done = True
+            if target_successful:
+                self.collected.select(cr)
+                self.highest_successful_run = cr
                 self.before_continue()
-                continue
+                break
 
             # Set up next target
 
@@ -269,15 +570,12 @@ class DownPassController(PassController):
             if next_target == self.current_target:
                 next_target = self.current_target - increment
             if next_target < self.sqm_lower_limit:
-                done = True
                 self.before_continue()
-                continue
+                break
             self.current_target = next_target
-            count_failures = 0
-            count_successes = 0
             self.before_continue()
-            continue
 
+        self.after_pass()
         return self.highest_successful_run
 
 
@@ -301,56 +599,35 @@ class UpPassController(PassController):
 
     def start(self):
         self.current_target = self.start_at
+        self.calibrating = self.calibration_length is not None
         self.prepare_sqm()
 
-        done = False
-        found_success = False
-
-        count_failures = 0
-        count_successes = 0
+        calibrated_target = None
 
-        while not done:
+        while True:
 
-            this_run = execute_one_test(router=self.router,
-                                        sqm=self.current_target,
-                                        dest_dir = self.destdir,
-                                        host = self.host,
-                                        test = self.test,
-                                        title = self.create_title(),
-                                        note = self.create_note(),
-                                        )
-
-            self.after_run(this_run)
-
-            run_successful = self.run_successful_test(this_run)
-            no_progress = self.no_progress_test(this_run)
-
-            cr = self.collected.add(this_run)
-
-            if run_successful:
-                count_successes += 1
-                cr.marked_good = True
-            else:
-                count_failures += 1
-                cr.marked_bad = True
+            target_successful, cr = self.evaluate_target()
 
-            # Typical condition where additional runs are required
-            if count_successes < self.target_success_requires and count_failures < self.target_failure_requires:
-                self.before_continue()
-                continue
+            if self.calibrating:
+                if target_successful:
+                    calibrated_target = self.current_target
+                else:
+                    # Short runs found the boundary, climb from the last good one with full-length runs
+                    self.calibrating = False
+                    self.current_target = calibrated_target or self.current_target
+                    self.before_continue()
+                    continue
 
             # Success at this SQM target
-            if count_successes >= self.target_success_requires:
-                self.highest_successful_run = self.collected.runs[-1]
-
+            elif target_successful:
+                self.highest_successful_run = cr
 
             # Failure at this SQM target
-            if count_failures >= self.target_failure_requires:
+            else:
                 if self.highest_successful_run:
-                    self.highest_successful_run.marked_selected = True
-                    done = True
+                    self.collected.select(self.highest_successful_run)
                     self.before_continue()
-                    continue
+                    break
                 else:
                     # Need to back off and try again
                     self.current_target = self.current_target / (self.factor**5)  # **4 would be 3 steps back
@@ -366,15 +643,12 @@ class UpPassController(PassController):
             if next_target == self.current_target:
                 next_target = self.current_target + increment
             if next_target > self.sqm_upper_limit:
-                done = True
                 self.before_continue()
-                continue
+                break
             self.current_target = next_target
-            count_failures = 0
-            count_successes = 0
             self.before_continue()
-            continue
 
+        self.after_pass()
         return self.highest_successful_run
 
 
@@ -383,38 +657,353 @@ class MultiRunController(PassController):
     def __init__(self, run_collector: RunCollector, router: Router, device, test, tunnel, destdir, logname,
                  runs=5, sqm=None):
         super().__init__(run_collector, router, device, test, tunnel, destdir, logname)
-        self.runs = runs
         self.sqm = sqm
         if (int(runs) != runs) or (runs % 2 != 1):
             new_runs = int(runs)
-            if (runs % 2 != 1):
-                runs += 1
+            if (new_runs % 2 != 1):
+                new_runs += 1
             print(f"runs={runs} not an odd integer. Changed to {new_runs}.", file=sys.stderr)
+            runs = new_runs
+        self.runs = runs
+
+        # Adaptive: rather than a fixed number of runs, add runs until the confidence interval
+        # of the estimator of totals is narrower than precision, relative, e.g. 0.02,
+        # taking at least min_runs and at most max_runs
+        self.precision = None
+        self.estimator = "median"
+        self.confidence = 0.95
+        self.min_runs = 3
+        self.max_runs = 11
+        self.achieved_precision = None
+
+    def use_adaptive_runs(self, precision=0.02, min_runs=3, max_runs=11, estimator="median", confidence=0.95):
+        self.precision = precision
+        self.min_runs = min_runs
+        self.max_runs = max_runs
+        self.estimator = estimator
+        self.confidence = confidence
+
+    def valid_runs(self):
+        runs = self.prior_runs + self.pass_runs
+        return [run for run in runs if not run.invalid and run.totals is not None]
+
+    def need_more_runs(self):
+        valid = self.valid_runs()
+        if self.precision is None:
+            return len(valid) < self.runs
+        self.achieved_precision = relative_interval_width([run.totals for run in valid],
+                                                          self.estimator, self.confidence)
+        if len(valid) < self.min_runs:
+            return True
+        if len(valid) >= self.max_runs:
+            return False
+        return self.achieved_precision is None or self.achieved_precision > self.precision
 
     def start(self):
         self.current_target = self.sqm
         self.prepare_sqm()
-
-        for run in range(self.runs):
-            this_run = execute_one_test(router=self.router,
-                                        sqm=self.current_target,
-                                        dest_dir = self.destdir,
-                                        host = self.host,
-                                        test = self.test,
-                                        title = self.create_title(),
-                                        note = self.create_note(),
-                                        )
+        self.pass_started = True
+
+        # Only top up what earlier runs, e.g. from a resumed sweep, have not already covered
+        self.prior_runs = self.collected.runs_at(self.current_target) if self.reuse_prior_runs else []
+        self.pass_runs = []
+
+        while self.need_more_runs():
+            this_run = self.execute_with_retry(router=self.router,
+                                               sqm=self.current_target,
+                                               dest_dir = self.destdir,
+                                               host = self.host,
+                                               test = self.test,
+                                               title = self.create_title(),
+                                               note = self.create_note(),
+                                               sampler = self.create_sampler(),
+                                               settler = self.create_settler(),
+                                               )
+            self.runs_executed += 1
 
             self.after_run(this_run)
             cr = self.collected.add(this_run)
+            self.pass_runs.append(cr)
+
+        # The lower of the middle two where an adaptive pass stopped on an even count
+        by_totals = lambda run: run.totals or 0  # Invalid runs have none
+        sorted_runs = sorted(self.valid_runs(), key=by_totals)
+        median_index = (len(sorted_runs) - 1) // 2
+        for run in self.collected.runs:
+            run.marked_selected = None
+        selected = sorted_runs[median_index]
+        self.collected.select(selected)
 
-        median_index = int(self.runs / 2)
-        by_totals = lambda run: run.totals
-        sorted_runs = sorted(self.collected.runs, key=by_totals)
-        sorted_runs[median_index].marked_selected = True
-        print(self.collected.dump(sort=by_totals, with_output_filename=False))
-        if self.logname:
-            with open(self.logname, mode='w') as logfile:
-                print(self.collected.dump(sort=by_totals), file=logfile)
+        self.achieved_precision = relative_interval_width([run.totals for run in sorted_runs],
+                                                          self.estimator, self.confidence)
+        if self.achieved_precision is not None:
+            selected.precision = (f"{self.estimator} CI {self.achieved_precision * 100:.1f} %"
+                                  f" at {self.confidence * 100:.0f} % of {len(sorted_runs)} runs")
+            print(f"Selected {selected.totals:.2f} Mbps after {self.runs_executed} runs, {selected.precision}")
+
+        self.summary_sort = by_totals
+        self.after_pass()
+        return selected
+
+
+class BisectPassController(PassController):
+
+    def __init__(self, run_collector: RunCollector, router: Router, device, test, tunnel, destdir, logname,
+                 start_at, factor=1.4, resolution=0.05):
+        super().__init__(run_collector, router, device, test, tunnel, destdir, logname)
+        self.factor = factor
+        self.start_at = start_at
+        self.resolution = resolution
+        self.calibration_resolution = 0.15
+
+        self.sqm_lower_limit = 1
+        self.sqm_upper_limit = 2000
+
+        self.highest_good_target = None
+        self.lowest_bad_target = None
+        self.runs_saved = None
+
+        # A bad end is never revisited, so one noisy failure would pull the result low;
+        # it takes two, as in the up passes, unless the one run failed by a wide margin
+        self.target_failure_requires = 2
+        self.decide_target = self._bracket_decide_target
+
+        # Each bracketing step is the previous one raised to this power, 2 doubles it in log space
+        self.factor_growth = 1
+        self._step = None
+
+    def _bracket_decide_target(self, results):
+        if len(results) == 1 and not results[0][1] and self.run_margin(results[0][0]) <= -self.sequential_strong_margin:
+            return False
+        return self._default_decide_target(results)
+
+    def warm_start(self, index, factor=1.05):
+        # Start from the last selected target of an earlier sweep, with a tight but growing bracket
+        prior = index.last_selected_target(self.device, self.tunnel, self.test)
+        if prior is None:
+            return None
+        print(f"Warm start for {self.device} {self.tunnel} {self.test} from earlier target {prior}")
+        self.start_at = prior
+        self.factor = factor
+        self.factor_growth = 2
+        self._step = None
+        return prior
+
+    def _expansion_step(self):
+        step = self._step or self.factor
+        self._step = step ** self.factor_growth
+        return step
+
+    def _next_target(self):
+        good = self.highest_good_target
+        bad = self.lowest_bad_target
+
+        if good is None:
+            next_target = self.round_target(bad / self._expansion_step())
+            if next_target >= bad:
+                next_target = self.round_target(bad - self.sqm_fractional_increment)
+            if next_target < self.sqm_lower_limit:
+                return None
+            return next_target
+
+        if bad is None:
+            if good >= self.sqm_upper_limit:
+                return None
+            next_target = self.round_target(min(good * self._expansion_step(), self.sqm_upper_limit))
+            if next_target <= good:
+                return None
+            return next_target
+
+        # Both ends bracketed, so bisect in log space
+        resolution = self.calibration_resolution if self.calibrating else self.resolution
+        if bad / good <= 1 + resolution:
+            return None
+        next_target = self.round_target(math.sqrt(good * bad))
+        if next_target <= good or next_target >= bad:
+            return None
+        return next_target
 
-        return sorted_runs[median_index]
\ No newline at end of file
+    def start(self):
+        self.current_target = self.round_target(min(max(self.start_at, self.sqm_lower_limit), self.sqm_upper_limit))
+        self.calibrating = self.calibration_length is not None
+        self.prepare_sqm()
+
+        while self.current_target is not None:
+
+            target_successful, cr = self.evaluate_target()
+
+            if target_successful:
+                self.highest_good_target = self.current_target
+                if not self.calibrating:
+                    self.highest_successful_run = cr
+            else:
+                self.lowest_bad_target = self.current_target
+
+            self.current_target = self._next_target()
+
+            if self.current_target is None and self.calibrating:
+                # Bracketed with short runs, now confirm and refine it with full-length runs
+                self.calibrating = False
+                self.current_target = self.highest_good_target
+                self.highest_good_target = None
+
+            self.before_continue()
+
+        if self.highest_successful_run:
+            self.collected.select(self.highest_successful_run)
+            chain_runs = estimate_pass_chain_runs(self.highest_good_target, self.start_at)
+            self.runs_saved = chain_runs - self.runs_executed
+            print(f"Bisection selected {self.highest_good_target} after {self.runs_executed} runs; "
+                  f"the down/up pass chain would take about {chain_runs} ({self.runs_saved} saved)")
+        else:
+            print(f"Bisection found no successful target after {self.runs_executed} runs")
+        self.before_continue()
+
+        self.after_pass()
+        return self.highest_successful_run
+
+
+class CoordinatePassController(BisectPassController):
+    # Searches download and upload rates separately, one axis at a time with the other held,
+    # for links and routers that are not symmetric. The first round judges each axis only on
+    # its own direction's flows, so the two are searched independently; later rounds judge
+    # whole runs, to refine the point where both directions pass together.
+
+    def __init__(self, run_collector: RunCollector, router: Router, device, test, tunnel, destdir, logname,
+                 start_at, factor=1.15, resolution=0.05, rounds=2):
+        super().__init__(run_collector, router, device, test, tunnel, destdir, logname,
+                         start_at=start_at, factor=factor, resolution=resolution)
+        self.rounds = rounds
+        self.independent_first_round = True
+
+        # Take a run selected at start_at, by an earlier pass on the same criteria, as passing
+        # there, rather than re-judging it from whichever earlier run comes first
+        self.trust_start = False
+        self._known_good = {}
+
+        self._point = None
+        self._axis = None
+        self._independent = False
+        self._whole_run_successful = self.run_successful_test
+        self.run_successful_test = self._axis_run_successful
+
+    def _axis_run_successful(self, run: FlentRun):
+        if self._independent and self._axis is not None:
+            return self._whole_run_successful(run, directions=(("download", "upload")[self._axis],))
+        return self._whole_run_successful(run)
+
+    def _axis_target(self, rate):
+        point = list(self._point)
+        point[self._axis] = rate
+        return make_target(*point)
+
+    def _search_axis(self, axis):
+        # One bisection along axis, from the current point; returns the best run found
+        self._axis = axis
+        self.highest_good_target = None
+        self.lowest_bad_target = None
+        self._step = None
+        best_run = None
+
+        rate = self._point[axis]
+        while rate is not None:
+            self.current_target = self._axis_target(rate)
+            if self.current_target in self._known_good:
+                target_successful, cr = True, self._known_good[self.current_target]
+            else:
+                target_successful, cr = self.evaluate_target()
+            if target_successful:
+                self.highest_good_target = rate
+                best_run = cr
+            else:
+                self.lowest_bad_target = rate
+            rate = self._next_target()
+            self.before_continue()
+
+        if best_run is not None:
+            self._point = split_target(best_run.target)
+        return best_run
+
+    def start(self):
+        self._point = split_target(self.round_target(self.start_at))
+        self.current_target = make_target(*self._point)
+        self.prepare_sqm()
+
+        self._known_good = {}
+        if self.trust_start:
+            selected = [run for run in self.collected.runs_at(self.current_target) if run.marked_selected]
+            if selected:
+                self._known_good[self.current_target] = selected[-1]
+
+        for n in range(self.rounds):
+            self._independent = self.independent_first_round and n == 0 and self.rounds > 1
+            start_point = self._point
+            for axis in (0, 1):
+                best_run = self._search_axis(axis)
+                if best_run is not None and not self._independent:
+                    self.highest_successful_run = best_run
+            print(f"Round {n + 1}: download/upload {self._point[0]}/{self._point[1]}")
+            if self._point == start_point and not self._independent:
+                break
+        self._axis = None
+
+        if self.highest_successful_run:
+            self.collected.select(self.highest_successful_run)
+            print(f"Selected download/upload {self._point[0]}/{self._point[1]} after {self.runs_executed} runs")
+        else:
+            print(f"Found no download/upload pair where both pass after {self.runs_executed} runs")
+        self.before_continue()
+
+        self.after_pass()
+        return self.highest_successful_run
+
+
+def estimate_pass_chain_runs(boundary, start_at, down_factor=0.7, up_factors=(1.15, 1.05),
+                             sqm_fractional_threshold=20, sqm_fractional_increment=0.1):
+    # Runs the DownPassController / UpPassController chain of perform_all_tests.py would need,
+    # if every target at or below boundary succeeds and every target above it fails.
+    # Targets already measured by an earlier pass are reused, so cost nothing.
+
+    def round_target(target):
+        if target < sqm_fractional_threshold:
+            return round(round(target / sqm_fractional_increment) * sqm_fractional_increment, 1)
+        return round(target)
+
+    runs = 0
+    measured = set()
+
+    target = start_at
+    while True:
+        measured.add(target)
+        if target <= boundary:
+            runs += 2
+            break
+        runs += 1
+        if target > 20:
+            next_target = round_target(target * down_factor)
+        else:
+            next_target = round_target(target * math.sqrt(down_factor))
+        if next_target == target:
+            next_target = target - sqm_fractional_increment
+        if next_target < 1:
+            return runs
+        target = next_target
+
+    for factor in up_factors:
+        selected = target
+        while True:
+            if target not in measured:
+                measured.add(target)
+                runs += 2
+            if target > boundary:
+                break
+            selected = target
+            next_target = round_target(target * factor)
+            if next_target == target:
+                next_target = target + sqm_fractional_increment
+            if next_target > 2000:
+                break
+            target = next_target
+        target = selected
+
+    return runs
@@ -0,0 +1,73 @@
+"""
+Copyright 2019 Jeff Klesky
+
+Redistribution and use in source and binary forms, with or without modification,
+are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright
+   notice, this list of conditions and the following disclaimer in the
+   documentation and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+"AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import shutil
+import subprocess
+
+from flentsqm.monitor import ping_once
+from flentsqm.router import Router, ifb_name, shaper_qdisc
+
+
+class TestbedUnhealthy(Exception):
+    # A run could not be made to work within its retries; the sweep cannot go on here
+    pass
+
+
+def netperf_reachable(host, timeout=5):
+    # A one second TCP_RR, the cheapest proof netserver answers; skipped without netperf here
+    if not shutil.which("netperf"):
+        return True
+    try:
+        sp = subprocess.run(["netperf", "-H", host, "-t", "TCP_RR", "-l", "1"],
+                            stdin=subprocess.DEVNULL, capture_output=True, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return False
+    return sp.returncode == 0
+
+
+def preflight(router: Router, host, iface=None, netperf=False):
+    # What would make a flent run at host fail or mislead right now, an empty list when ready.
+    # With iface, also that SQM's shaper is in place on it and its IFB, whichever script installed it.
+    problems = []
+
+    if shutil.which("ping") and ping_once(host) is None and ping_once(host) is None:
+        problems.append(f"no ping reply from {host}")
+    elif netperf and not netperf_reachable(host):
+        problems.append(f"netperf to {host} failed")
+
+    cmd = ["true"]
+    if iface:
+        cmd = ["tc", "qdisc", "show", "dev", iface, ";", "echo", "--", ";",
+               "tc", "qdisc", "show", "dev", ifb_name(iface)]
+    sp = router.run_cmd(cmd)
+    if sp.returncode == 255:
+        problems.append(f"no ssh to {router.destination}")
+    elif iface:
+        egress, _, ingress = sp.stdout.decode('utf-8').partition("--\n")
+        if shaper_qdisc(egress) is None or shaper_qdisc(ingress) is None:
+            problems.append(f"SQM qdiscs missing on {iface}")
+
+    return problems
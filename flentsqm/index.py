@@ -0,0 +1,266 @@
+"""
+Copyright 2019 Jeff Klesky
+
+Redistribution and use in source and binary forms, with or without modification,
+are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright
+   notice, this list of conditions and the following disclaimer in the
+   documentation and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+"AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import os
+import re
+import sqlite3
+
+from flentsqm.journal import Journal
+from flentsqm.naming import protect_for_filename
+from flentsqm.resources import ResourceSummary
+from flentsqm.runs import FlentRun, RunCollector, make_target
+
+
+_re_sweep_dir = re.compile(r"^(.+)_([0-9]{4}-[0-9]{2}-[0-9]{2})_([0-9]{2})([0-9]{2})$")
+_re_title_target = re.compile(r"_SQM_([0-9.]+|None)_([0-9.]+|None)")
+
+# target is the download rate where download and upload were shaped differently
+_columns = ["source", "sweep_dir", "device", "date", "tunnel", "test", "collector", "target",
+            "target_download", "target_upload", "totals", "download", "upload", "ping", "coefvar", "coefvar_download", "coefvar_upload",
+            "sigma", "latency_p99", "marked_good", "marked_bad", "marked_selected",
+            "fidelity", "length", "truncated", "timestamp", "data_file",
+            "router_cpu", "router_softirq", "qdisc_drops", "invalid", "settle_time",
+            "selection"]
+
+
+class ResultsIndex:
+    # SQLite index of every run under any number of Device_YYYY-MM-DD_HHMM sweep
+    # directories, loaded from their journals or, for older sweeps, their .flent.gz files
+
+    def __init__(self, path="flentsqm_index.sqlite"):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, mtime REAL, size INTEGER)")
+        self.db.execute(f"CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, {', '.join(_columns)})")
+        have = [row["name"] for row in self.db.execute("PRAGMA table_info(runs)")]
+        for column in _columns:
+            if column not in have:
+                # Index from before the column existed; runs before it were all symmetric
+                self.db.execute(f"ALTER TABLE runs ADD COLUMN {column}")
+                if column.startswith("target_"):
+                    self.db.execute(f"UPDATE runs SET {column} = target")
+        self.db.execute("CREATE INDEX IF NOT EXISTS runs_by_key ON runs (device, tunnel, test, target)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS runs_by_source ON runs (source)")
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def _unchanged(self, path):
+        stat = os.stat(path)
+        row = self.db.execute("SELECT mtime, size FROM files WHERE path = ?", (path,)).fetchone()
+        return row is not None and row["mtime"] == stat.st_mtime and row["size"] == stat.st_size
+
+    def _mark_indexed(self, path):
+        stat = os.stat(path)
+        self.db.execute("INSERT OR REPLACE INTO files (path, mtime, size) VALUES (?, ?, ?)",
+                        (path, stat.st_mtime, stat.st_size))
+
+    def _insert(self, run: FlentRun, **fields):
+        values = dict(fields,
+                      target=run.target_download,
+                      target_download=run.target_download,
+                      target_upload=run.target_upload,
+                      totals=run.totals,
+                      download=run.download,
+                      upload=run.upload,
+                      ping=run.ping,
+                      coefvar=run.coefvar_both,
+                      coefvar_download=run.coefvar_download,
+                      coefvar_upload=run.coefvar_upload,
+                      sigma=run.stddev_both,
+                      latency_p99=run.latency_p99,
+                      marked_good=run.marked_good,
+                      marked_bad=run.marked_bad,
+                      marked_selected=run.marked_selected,
+                      fidelity=run.fidelity,
+                      length=run.length,
+                      truncated=run.truncated,
+                      invalid=run.invalid,
+                      settle_time=run.settle_time,
+                      timestamp=run.timestamp,
+                      data_file=run.data_file)
+        if run.resources:
+            values.update(router_cpu=run.resources.cpu_busy_peak,
+                          router_softirq=run.resources.softirq_peak,
+                          qdisc_drops=run.resources.qdisc_drops)
+        names = [name for name in _columns if name in values]
+        self.db.execute(f"INSERT INTO runs ({', '.join(names)}) VALUES ({', '.join('?' * len(names))})",
+                        [values[name] for name in names])
+
+    def _index_journal(self, path, sweep_fields):
+        if self._unchanged(path):
+            return 0
+        # The journal grows in place, so re-read it whole
+        self.db.execute("DELETE FROM runs WHERE source = ?", (path,))
+        sweep, collectors = Journal(path).load()
+        count = 0
+        for key, collector in collectors.items():
+            for run in collector.runs:
+                self._insert(run, source=path, collector=key, selection=collector.selection_rank(run),
+                             tunnel=collector.tunnel or "None", test=collector.test,
+                             **dict(sweep_fields, device=sweep.get("device", sweep_fields["device"])))
+                count += 1
+        self._mark_indexed(path)
+        return count
+
+    def _index_data_file(self, path, tunnel, sweep_fields):
+        if self._unchanged(path):
+            return 0
+        run = FlentRun.from_data_file(path)
+        m = _re_title_target.search(run.title or os.path.basename(path))
+        if m and m.group(1) != "None":
+            rates = [float(rate) for rate in m.groups()]
+            rates = [int(rate) if rate == int(rate) else rate for rate in rates]
+            run.target = make_target(*rates)
+        self._insert(run, source=path, collector=None, tunnel=tunnel, test=run.test, **sweep_fields)
+        self._mark_indexed(path)
+        return 1
+
+    def _index_sweep(self, sweep_dir, m):
+        sweep_fields = {"sweep_dir": sweep_dir,
+                        "device": m.group(1),
+                        "date": f"{m.group(2)} {m.group(3)}:{m.group(4)}"}
+        journal = os.path.join(sweep_dir, "journal.jsonl")
+        if os.path.exists(journal):
+            return self._index_journal(journal, sweep_fields)
+        count = 0
+        for dirpath, dirnames, filenames in os.walk(sweep_dir):
+            tunnel = os.path.relpath(dirpath, sweep_dir).split(os.sep)[0]
+            for filename in sorted(filenames):
+                if filename.endswith(".flent.gz"):
+                    count += self._index_data_file(os.path.join(dirpath, filename), tunnel, sweep_fields)
+        return count
+
+    def update(self, roots):
+        # Index new or changed sweeps found anywhere under roots; returns runs added
+        count = 0
+        for root in roots:
+            for dirpath, dirnames, filenames in os.walk(os.path.abspath(root)):
+                m = _re_sweep_dir.match(os.path.basename(dirpath))
+                if m:
+                    count += self._index_sweep(dirpath, m)
+                    dirnames[:] = []
+        self.db.commit()
+        return count
+
+    def query(self, device=None, tunnel=None, test=None, target=None, since=None, until=None,
+              shaped=None, selected=None, order_by="device, date, tunnel, test, target IS NOT NULL, totals"):
+        where = []
+        args = []
+        for column, value in (("device", device), ("tunnel", tunnel), ("test", test), ("target", target)):
+            if value is not None:
+                where.append(f"{column} = ?")
+                args.append(value)
+        if since:
+            where.append("date >= ?")
+            args.append(since)
+        if until:
+            where.append("date <= ?")
+            args.append(until)
+        if shaped is not None:
+            where.append("target IS NOT NULL" if shaped else "target IS NULL")
+        if selected is not None:
+            where.append("marked_selected" if selected else "NOT coalesce(marked_selected, 0)")
+        sql = "SELECT * FROM runs"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += f" ORDER BY {order_by}"
+        return self.db.execute(sql, args).fetchall()
+
+
+    def last_selected_target(self, device, tunnel, test):
+        # (download, upload) where the two were shaped differently.
+        # Journals record the device name as given, older sweeps only its directory form
+        row = self.db.execute("SELECT target_download, target_upload FROM runs"
+                              " WHERE device IN (?, ?) AND tunnel = ? AND test = ?"
+                              " AND marked_selected AND target IS NOT NULL AND fidelity = 'full'"
+                              " ORDER BY date DESC, coalesce(selection, -1) DESC, timestamp DESC LIMIT 1",
+                              (device, protect_for_filename(device), tunnel or "None", test)).fetchone()
+        if row is None:
+            return None
+        rates = [row["target_download"], row["target_upload"]]
+        rates = [int(rate) if rate is not None and rate == int(rate) else rate for rate in rates]
+        return make_target(*rates)
+
+    def search_runs(self, device, tunnel, test):
+        # Mean shaped runs per sweep of this device, for estimating how long a search takes
+        row = self.db.execute("SELECT avg(n) AS runs FROM"
+                              " (SELECT count(*) AS n FROM runs"
+                              "  WHERE device IN (?, ?) AND tunnel = ? AND test = ? AND target IS NOT NULL"
+                              "  GROUP BY sweep_dir)",
+                              (device, protect_for_filename(device), tunnel or "None", test)).fetchone()
+        return row["runs"]
+
+
+def dump_rows(rows, sort=None):
+    # The same layout as RunCollector.dump(), one block per sweep, tunnel, test and shaping
+    groups = {}
+    for row in rows:
+        key = (row["device"], row["date"], row["tunnel"], row["test"], row["target"] is not None)
+        groups.setdefault(key, []).append(row)
+
+    collector = RunCollector()
+    this_output = ''
+    for (device, date, tunnel, test, shaped), group in groups.items():
+        if sort:
+            group = sorted(group, key=sort)
+        this_output += f"{device} {date} {tunnel} {test}{' SQM' if shaped else ''}\n"
+        this_output += "    Total          Ping       CoV        down     up        Target     sigma\n"
+        for row in group:
+            this_output += collector.dump_one(IndexedRun(row), with_output_filename=False)
+        this_output += "\n"
+    return this_output
+
+
+class IndexedRun:
+    # Just enough of a FlentRun, from an index row, for RunCollector.dump_one()
+
+    def __init__(self, row):
+        rates = [row["target_download"], row["target_upload"]]
+        rates = [int(rate) if rate is not None and rate == int(rate) else rate for rate in rates]
+        self.target = make_target(*rates)
+        self.totals = row["totals"]
+        self.ping = row["ping"]
+        self.coefvar_both = row["coefvar"]
+        self.coefvar_download = row["coefvar_download"]
+        self.coefvar_upload = row["coefvar_upload"]
+        self.stddev_both = row["sigma"]
+        self.marked_good = row["marked_good"]
+        self.marked_bad = row["marked_bad"]
+        self.marked_selected = row["marked_selected"]
+        self.truncated = row["truncated"]
+        self.invalid = row["invalid"]
+        self.settle_time = row["settle_time"]
+        self.length = row["length"]
+        self.data_file = row["data_file"]
+        self.resources = None
+        if row["router_cpu"] is not None:
+            self.resources = ResourceSummary.from_dict({"cpu_busy_peak": row["router_cpu"],
+                                                        "softirq_peak": row["router_softirq"],
+                                                        "qdisc_drops": row["qdisc_drops"]})
+        self.formatted_rows = {}
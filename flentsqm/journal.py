@@ -0,0 +1,175 @@
+"""
+Copyright 2019 Jeff Klesky
+
+Redistribution and use in source and binary forms, with or without modification,
+are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright
+   notice, this list of conditions and the following disclaimer in the
+   documentation and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+"AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import json
+import os
+import time
+
+from flentsqm.resources import ResourceSummary
+from flentsqm.runs import FlentRun, RunCollector
+
+
+def resolve_data_file(data_file, journal_dir):
+    # flent writes data file paths relative to where the sweep was started, the parent of
+    # its directory as perform_all_tests.py lays it out. Find the file from any cwd, and
+    # also after the sweep directory was moved, by its path below the sweep directory.
+    if not data_file or (os.path.isabs(data_file) and os.path.exists(data_file)):
+        return data_file
+    parts = os.path.normpath(data_file).split(os.sep)
+    for base in (os.path.dirname(journal_dir), journal_dir):
+        for n in range(len(parts)):
+            candidate = os.path.join(base, *parts[n:])
+            if os.path.exists(candidate):
+                return os.path.abspath(candidate)
+    return data_file
+
+
+class Journal:
+    # Append-only record of a sweep, one JSON object per line, from which the
+    # RunCollectors and the progress of each pass can be rebuilt after a crash
+
+    def __init__(self, path):
+        self.path = path
+        self._next_id = 0
+        self._run_ids = {}
+        self._marks = {}
+        self._collector_keys = set()
+        self.states = {}
+
+    def _append(self, record):
+        record["time"] = time.time()
+        with open(self.path, mode='a') as journal_file:
+            print(json.dumps(record), file=journal_file, flush=True)
+
+    @staticmethod
+    def _marks_of(run: FlentRun):
+        return [run.marked_good, run.marked_bad, run.marked_selected]
+
+    def record_sweep(self, **kwargs):
+        self._append(dict(event="sweep", **kwargs))
+
+    def record_collector(self, key, collector: RunCollector):
+        if key in self._collector_keys:
+            return
+        self._collector_keys.add(key)
+        self._append({"event": "collector",
+                      "key": key,
+                      "device": collector.device,
+                      "tunnel": collector.tunnel,
+                      "test": collector.test})
+
+    def record_run(self, key, run: FlentRun):
+        run_id = self._next_id
+        self._next_id += 1
+        self._run_ids[id(run)] = run_id
+        self._marks[run_id] = self._marks_of(run)
+        self._append({"event": "run",
+                      "key": key,
+                      "id": run_id,
+                      "target": run.target,
+                      "timestamp": run.timestamp,
+                      "data_file": os.path.abspath(run.data_file) if run.data_file else None,
+                      "length": run.length,
+                      "truncated": run.truncated,
+                      "invalid": run.invalid,
+                      "resources": run.resources.as_dict() if run.resources else None,
+                      "settle_time": run.settle_time,
+                      "marks": self._marks[run_id],
+                      "output": run.flent_output_string})
+
+    def record_selection(self, key, run: FlentRun):
+        run_id = self._run_ids.get(id(run))
+        if run_id is None:
+            return
+        self._append({"event": "select", "key": key, "id": run_id})
+
+    def record_marks(self, run: FlentRun):
+        run_id = self._run_ids.get(id(run))
+        if run_id is None:
+            return
+        marks = self._marks_of(run)
+        if marks != self._marks[run_id]:
+            self._marks[run_id] = marks
+            self._append({"event": "marks", "id": run_id, "marks": marks})
+
+    def record_state(self, key, pass_name, state):
+        self.states[(key, pass_name)] = state
+        self._append({"event": "state", "key": key, "pass": pass_name, "state": state})
+
+    def pass_complete(self, key, pass_name):
+        return bool(self.states.get((key, pass_name), {}).get("complete"))
+
+    def load(self):
+        # Rebuild collectors, keyed as they were recorded, and continue appending after them
+        collectors = {}
+        sweep = {}
+        runs = {}
+        if not os.path.exists(self.path):
+            return sweep, collectors
+        with open(self.path) as journal_file:
+            for line in journal_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # A torn last line from the crash we are resuming from
+                event = record.get("event")
+                if event == "sweep":
+                    sweep.update(record)
+                elif event == "collector":
+                    key = record["key"]
+                    self._collector_keys.add(key)
+                    collectors[key] = RunCollector(device=record["device"], tunnel=record["tunnel"],
+                                                   test=record["test"])
+                    collectors[key].attach_journal(self, key)
+                elif event == "run":
+                    key = record["key"]
+                    data_file = resolve_data_file(record["data_file"], os.path.dirname(os.path.abspath(self.path)))
+                    run = FlentRun(record["output"], target=record["target"], data_file=data_file)
+                    run.timestamp = record["timestamp"]
+                    run.length = record["length"]
+                    run.truncated = record["truncated"]
+                    run.invalid = record.get("invalid")
+                    run.settle_time = record.get("settle_time")
+                    if record.get("resources"):
+                        run.resources = ResourceSummary.from_dict(record["resources"])
+                    run.marked_good, run.marked_bad, run.marked_selected = record["marks"]
+                    collectors[key].runs.append(run)
+                    runs[record["id"]] = run
+                    self._run_ids[id(run)] = record["id"]
+                    self._marks[record["id"]] = record["marks"]
+                    self._next_id = max(self._next_id, record["id"] + 1)
+                elif event == "marks":
+                    run = runs.get(record["id"])
+                    if run is not None:
+                        run.marked_good, run.marked_bad, run.marked_selected = record["marks"]
+                        self._marks[record["id"]] = record["marks"]
+                elif event == "select":
+                    run = runs.get(record["id"])
+                    if run is not None:
+                        collectors[record["key"]].selection.append(run)
+                elif event == "state":
+                    self.states[(record["key"], record["pass"])] = record["state"]
+        return sweep, collectors
@@ -0,0 +1,115 @@
+"""
+Copyright 2019 Jeff Klesky
+
+Redistribution and use in source and binary forms, with or without modification,
+are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright
+   notice, this list of conditions and the following disclaimer in the
+   documentation and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+"AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import re
+import statistics
+import subprocess
+import time
+
+from flentsqm.router import Router
+
+
+_re_ping_time = re.compile(r"time[=<]([0-9.]+) ?ms")
+
+
+def ping_once(host, timeout=1):
+    # Round-trip time in ms of a single ICMP echo from this machine, or None if lost
+    sp = subprocess.run(["ping", "-n", "-c", "1", "-W", f"{timeout}", host],
+                        stdin=subprocess.DEVNULL, capture_output=True)
+    m = _re_ping_time.search(sp.stdout.decode('utf-8'))
+    if sp.returncode or not m:
+        return None
+    return float(m.group(1))
+
+
+def read_iface_bytes(router: Router, iface):
+    sp = router.run_cmd(["cat", f"/sys/class/net/{iface}/statistics/rx_bytes",
+                         f"/sys/class/net/{iface}/statistics/tx_bytes"])
+    try:
+        rx_bytes, tx_bytes = [int(x) for x in sp.stdout.decode('utf-8').split()]
+    except ValueError:
+        return None
+    return rx_bytes, tx_bytes
+
+
+class RunMonitor:
+    # Watches a running flent test from the outside, with a ping of its own to the
+    # netperf host and the byte counters of the shaped interface on the router,
+    # and says when the outcome is already settled so the run can be stopped early.
+
+    def __init__(self, router: Router, host, iface, target=None, ping_limit=None, sqm_fudge_factor=0.7):
+        self.router = router
+        self.host = host
+        self.iface = iface
+        self.target = target
+        self.ping_limit = ping_limit
+        self.sqm_fudge_factor = sqm_fudge_factor
+
+        self.interval = 1
+        self.warmup = 15            # seconds, flent's idle lead-in plus ramp-up
+        self.window = 5             # consecutive samples that must all agree
+        self.ping_abort_ratio = 2   # median ping this far over the limit is hopeless
+
+        self._last_bytes = None
+        self._last_time = None
+        self.samples = []
+
+    def sample(self):
+        now = time.time()
+        rtt = ping_once(self.host)
+        counters = read_iface_bytes(self.router, self.iface) if self.iface else None
+        mbps = None
+        if counters and self._last_bytes:
+            elapsed = now - self._last_time
+            if elapsed > 0:
+                mbps = max(counters[0] - self._last_bytes[0],
+                           counters[1] - self._last_bytes[1]) * 8 / elapsed / 1e6
+        if counters:
+            self._last_bytes = counters
+            self._last_time = now
+        self.samples.append((now, rtt, mbps))
+        return rtt, mbps
+
+    def poll(self, elapsed):
+        self.sample()
+        if elapsed < self.warmup or len(self.samples) < self.window:
+            return None
+        recent = self.samples[-self.window:]
+
+        if self.ping_limit:
+            # Lost pings count as over the limit
+            rtts = [rtt if rtt is not None else float('inf') for t, rtt, mbps in recent]
+            if (min(rtts) > self.ping_limit
+                    and statistics.median(rtts) > self.ping_limit * self.ping_abort_ratio):
+                return f"ping above {self.ping_limit} ms, median {statistics.median(rtts):.1f} ms"
+
+        if self.target:
+            floor = self.target * self.sqm_fudge_factor
+            rates = [mbps for t, rtt, mbps in recent if mbps is not None]
+            if len(rates) == self.window and max(rates) < floor:
+                return f"throughput below {floor:.1f} Mbps, peak {max(rates):.1f} Mbps"
+
+        return None
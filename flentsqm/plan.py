@@ -0,0 +1,231 @@
+"""
+Copyright 2019 Jeff Klesky
+
+Redistribution and use in source and binary forms, with or without modification,
+are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright
+   notice, this list of conditions and the following disclaimer in the
+   documentation and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+"AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import json
+
+from flentsqm.scheduler import Testbed, shared_items
+
+# A sweep as a list of steps, (kind, tunnel, test) with kind "median" for the unshaped
+# baseline and "search" for the SQM passes that start from it, ordered so the router
+# changes SQM config as few times as possible.
+
+
+DEFAULT_TUNNELS = [None, "WireGuard", "OpenVPN"]
+DEFAULT_TESTS = ["tcp_8down", "tcp_8up", "rrul"]
+
+# Mean runs per search, from benchmark_search.py, when there is no history for the device
+DEFAULT_SEARCH_RUNS = {"updown": 12, "bisect": 11}
+
+# Mean runs of the passes that can follow or replace a search, from the same simulator:
+# an asymmetric rrul search seeded from tcp_8down and tcp_8up, one refining a symmetric
+# result, and a ping pass
+DEFAULT_COORDINATE_RUNS = 30
+DEFAULT_REFINE_RUNS = 12
+DEFAULT_PING_RUNS = 5
+
+
+def router_state(step):
+    # What the router's SQM config has to be for a step. Disabled SQM ignores
+    # interface and overhead, so every unshaped step needs the same state.
+    kind, tunnel, test = step
+    if kind == "median":
+        return "disabled"
+    return f"enabled on {tunnel}"
+
+
+def transitions(steps, state=None):
+    # SQM restarts for changes of interface, overhead or enabled between steps
+    count = 0
+    for step in steps:
+        if router_state(step) != state:
+            state = router_state(step)
+            count += 1
+    return count
+
+
+def plan_steps(tunnels, tests, state=None):
+    # Greedy: of the steps whose baseline has run, the one needing no router change,
+    # else the first in tunnel and test order
+    pending = [("median", tunnel, test) for tunnel in tunnels for test in tests] + \
+              [("search", tunnel, test) for tunnel in tunnels for test in tests]
+    done = set()
+    steps = []
+    while pending:
+        ready = [step for step in pending if step[0] == "median" or ("median",) + step[1:] in done]
+        step = next((step for step in ready if router_state(step) == state), ready[0])
+        pending.remove(step)
+        done.add(step)
+        steps.append(step)
+        state = router_state(step)
+    return steps
+
+
+def naive_steps(tunnels, tests):
+    # The order perform_all_tests.py runs in
+    steps = []
+    for tunnel in tunnels:
+        for test in tests:
+            steps += [("median", tunnel, test), ("search", tunnel, test)]
+    return steps
+
+
+def expand_items(items):
+    # The steps of shared items, in the order a single testbed would run them
+    steps = []
+    for kind, tunnel, tests in items:
+        for test in tests:
+            steps += [("median", tunnel, test), ("search", tunnel, test)]
+    return steps
+
+
+class MatrixConfig:
+    # A test matrix from a JSON file, see perform_matrix.py for an example
+
+    def __init__(self, config):
+        self.testbeds = [Testbed.from_dict(d) for d in config["testbeds"]]
+        self.tunnels = config.get("tunnels", DEFAULT_TUNNELS)
+
+        self.tests = []
+        self.test_settings = {}
+        for test in config.get("tests", DEFAULT_TESTS):
+            # Either a test name or {"name": test, <controller settings for it>}
+            if isinstance(test, dict):
+                test = dict(test)
+                name = test.pop("name")
+                self.test_settings[name] = test
+                test = name
+            self.tests.append(test)
+
+        self.asymmetric = config.get("asymmetric", False)
+        if self.asymmetric:
+            # rrul searches start from the tcp_8down and tcp_8up results, so run after them
+            self.tests.sort(key=lambda test: test == "rrul")
+
+        self.chain = config.get("chain", "updown")
+        if self.chain not in DEFAULT_SEARCH_RUNS:
+            raise ValueError(f"Unknown chain '{self.chain}', not one of {', '.join(DEFAULT_SEARCH_RUNS)}")
+        self.median_runs = config.get("median_runs", 5)
+        if isinstance(self.median_runs, dict):
+            unknown = set(self.median_runs) - {"precision", "min_runs", "max_runs", "estimator", "confidence"}
+            if unknown:
+                raise ValueError(f"Unknown median_runs settings: {', '.join(sorted(unknown))}")
+        self.ping_limit = config.get("ping_limit", 10)
+        self.controller_settings = config.get("controller", {})
+
+        estimate = config.get("estimate", {})
+        self.run_seconds = estimate.get("run_seconds", 75)  # flent -l 60, its idle lead-in and out, start-up
+        self.restart_seconds = estimate.get("restart_seconds", 10)
+        self.search_runs = estimate.get("search_runs", DEFAULT_SEARCH_RUNS[self.chain])
+        self.coordinate_runs = estimate.get("coordinate_runs", DEFAULT_COORDINATE_RUNS)
+        self.refine_runs = estimate.get("refine_runs", DEFAULT_REFINE_RUNS)
+        self.ping_runs = estimate.get("ping_runs", DEFAULT_PING_RUNS)  # Counted for every search, as if needed
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls(json.load(f))
+
+    @property
+    def devices(self):
+        devices = []
+        for testbed in self.testbeds:
+            if testbed.device not in devices:
+                devices.append(testbed.device)
+        return devices
+
+    def configure(self, sweep):
+        sweep.chain = self.chain
+        sweep.median_runs = self.median_runs
+        sweep.ping_limit = self.ping_limit
+        sweep.asymmetric = self.asymmetric
+        sweep.controller_settings = self.controller_settings
+        sweep.test_settings = self.test_settings
+        return sweep
+
+    def plan(self):
+        return plan_steps(self.tunnels, self.tests)
+
+    def step_runs(self, device, step, index=None):
+        kind, tunnel, test = step
+        if kind == "median":
+            if isinstance(self.median_runs, dict):
+                # Adaptive, somewhere between its bounds
+                return (self.median_runs.get("min_runs", 3) + self.median_runs.get("max_runs", 11)) / 2
+            return self.median_runs
+        if index:
+            # Every shaped run of past sweeps, so ping and coordinate passes included
+            runs = index.search_runs(device, tunnel, test)
+            if runs:
+                return runs
+        runs = self.search_runs
+        if self.asymmetric and test == "rrul":
+            if "tcp_8down" in self.tests and "tcp_8up" in self.tests:
+                runs = self.coordinate_runs
+            else:
+                runs += self.refine_runs
+        if self.ping_limit:
+            runs += self.ping_runs
+        return runs
+
+    def estimate(self, device, steps, index=None):
+        # Seconds for one testbed to run steps, from past runs of the device where indexed
+        runs = sum(self.step_runs(device, step, index) for step in steps)
+        return runs * self.run_seconds + transitions(steps) * self.restart_seconds
+
+    def describe(self, index=None):
+        # What each device will really run: the plan on a lone testbed, whole items where
+        # several testbeds of the device share them, as flentsqm.scheduler.DevicePool does
+        steps = self.plan()
+        naive = transitions(naive_steps(self.tunnels, self.tests))
+        out = ''
+        shown = set()
+        for device in self.devices:
+            testbeds = len([t for t in self.testbeds if t.device == device])
+            if (testbeds > 1) in shown:
+                continue
+            shown.add(testbeds > 1)
+            sharing = [d for d in self.devices if (len([t for t in self.testbeds if t.device == d]) > 1) == (testbeds > 1)]
+            if testbeds == 1:
+                out += f"{', '.join(sharing)}: {len(steps)} steps, {transitions(steps)} SQM reconfigurations"
+                out += f" (tunnel by tunnel: {naive})\n"
+                for kind, tunnel, test in steps:
+                    out += f"    {kind:<8s} {tunnel or 'None':<10s} {test}\n"
+            else:
+                items = shared_items(steps, self.asymmetric)
+                out += f"{', '.join(sharing)}: {len(items)} items, each run whole on whichever testbed is free;"
+                out += f" at most {transitions(expand_items(items))} SQM reconfigurations per testbed\n"
+                for kind, tunnel, tests in items:
+                    out += f"    {'item':<8s} {tunnel or 'None':<10s} {' '.join(tests)}\n"
+        longest = 0
+        for device in self.devices:
+            testbeds = len([t for t in self.testbeds if t.device == device])
+            device_steps = steps if testbeds == 1 else expand_items(shared_items(steps, self.asymmetric))
+            seconds = self.estimate(device, device_steps, index) / testbeds
+            longest = max(longest, seconds)
+            out += f"{device}: about {seconds / 3600:.1f} h on {testbeds} testbed(s)\n"
+        out += f"Estimated wall-clock: {longest / 3600:.1f} h\n"
+        return out
+
@@ -0,0 +1,227 @@
+"""
+Copyright 2019 Jeff Klesky
+
+Redistribution and use in source and binary forms, with or without modification,
+are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright
+   notice, this list of conditions and the following disclaimer in the
+   documentation and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+"AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import re
+import threading
+import time
+
+import numpy as np
+
+from flentsqm.router import Router
+
+
+_re_qdisc = re.compile(r"^qdisc (\S+) (\S+):")
+_re_sent = re.compile(r"Sent (\d+) bytes (\d+) pkt \(dropped (\d+), overlimits (\d+)")
+_re_backlog = re.compile(r"backlog (\d+)b (\d+)p")
+# cake has a marks row with a column per tin; fq_codel an ecn_mark counter among others on its line
+_re_marks = re.compile(r"\b(?:marks|ecn_mark)((?:\s+\d+)+)")
+
+
+class RouterSampler:
+    # Streams /proc/stat, /proc/softirqs, /proc/meminfo and "tc -s qdisc" from the router
+    # every interval seconds, from one shell loop over one ssh channel, while a run goes
+
+    def __init__(self, router: Router, devices=None, interval=1):
+        self.router = router
+        self.devices = [device for device in (devices or []) if device]
+        self.interval = interval
+        self.samples = []
+        self._proc = None
+        self._thread = None
+        self._sample_time = None
+
+    def script(self):
+        tc = ''.join(f" echo '@@dev {device}'; tc -s qdisc show dev {device};" for device in self.devices)
+        if not tc:
+            tc = " echo '@@dev'; tc -s qdisc show;"
+        return (f"while :; do echo '@@sample'; echo '@@stat'; cat /proc/stat; echo '@@softirqs'; cat /proc/softirqs;"
+                f" echo '@@meminfo'; cat /proc/meminfo;{tc} sleep {self.interval}; done")
+
+    def start(self):
+        self.samples = []
+        self._proc = self.router.open_channel(self.script())
+        self._thread = threading.Thread(target=self._read, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._proc is None:
+            return None
+        self._proc.terminate()
+        try:
+            self._proc.wait(timeout=5)
+        except Exception:
+            self._proc.kill()
+        self._thread.join(timeout=5)
+        self._proc = None
+        return ResourceSummary(self.samples)
+
+    def _read(self):
+        lines = []
+        for line in self._proc.stdout:
+            line = line.decode('utf-8', errors='replace').rstrip('\n')
+            if line == "@@sample":
+                if lines:
+                    self.samples.append(parse_sample(lines, self._sample_time))
+                lines = []
+                self._sample_time = time.time()
+            else:
+                lines.append(line)
+        # The last sample may be cut off by terminate(), so it is dropped
+
+
+def parse_sample(lines, sample_time=None):
+    sample = {"time": sample_time, "cpu": {}, "softirqs": {}, "meminfo": {}, "qdiscs": {}}
+    section = None
+    device = ''
+    qdisc = None
+    softirq_cpus = 0
+    for line in lines:
+        if line.startswith("@@"):
+            section, _, device = line[2:].partition(' ')
+            continue
+        if section == "stat" and line.startswith("cpu"):
+            fields = line.split()
+            sample["cpu"][fields[0]] = [int(x) for x in fields[1:]]
+        elif section == "softirqs":
+            fields = line.split()
+            if fields and fields[0].startswith("CPU"):
+                softirq_cpus = len(fields)
+            elif fields and fields[0].endswith(':'):
+                sample["softirqs"][fields[0][:-1]] = [int(x) for x in fields[1:softirq_cpus + 1]]
+        elif section == "meminfo":
+            fields = line.split()
+            if len(fields) >= 2 and fields[0].endswith(':'):
+                sample["meminfo"][fields[0][:-1]] = int(fields[1])
+        elif section == "dev":
+            m = _re_qdisc.match(line)
+            if m:
+                qdisc = {"kind": m.group(1), "bytes": 0, "packets": 0, "dropped": 0, "overlimits": 0,
+                         "backlog_bytes": 0, "backlog_packets": 0, "marks": 0}
+                sample["qdiscs"][f"{device} {m.group(1)} {m.group(2)}".strip()] = qdisc
+                continue
+            if qdisc is None:
+                continue
+            m = _re_sent.search(line)
+            if m:
+                qdisc["bytes"], qdisc["packets"], qdisc["dropped"], qdisc["overlimits"] = \
+                    [int(x) for x in m.groups()]
+                continue
+            m = _re_backlog.search(line)
+            if m:
+                qdisc["backlog_bytes"], qdisc["backlog_packets"] = [int(x) for x in m.groups()]
+                continue
+            m = _re_marks.search(line)
+            if m:
+                qdisc["marks"] = sum(int(x) for x in m.group(1).split())
+    return sample
+
+
+def cpu_fractions(before, after):
+    # (busy, softirq) share of each CPU between two /proc/stat samples; iowait counts as idle
+    fractions = {}
+    for name, fields in after.items():
+        if name == "cpu" or name not in before:
+            continue
+        delta = [a - b for a, b in zip(fields, before[name])][:8]
+        total = sum(delta)
+        if total <= 0:
+            continue
+        idle = delta[3] + (delta[4] if len(delta) > 4 else 0)
+        softirq = delta[6] if len(delta) > 6 else 0
+        fractions[name] = ((total - idle) / total, softirq / total)
+    return fractions
+
+
+class ResourceSummary:
+    # What the router went through during one run. The busiest core is what matters,
+    # as crypto and the shaper often sit on one CPU while the others idle.
+
+    _fields = ["cpu_busy_peak", "cpu_busy_mean", "cpu_headroom", "softirq_peak",
+               "mem_available_min", "qdisc_drops", "qdisc_marks", "backlog_peak"]
+
+    def __init__(self, samples=None):
+        self.samples = samples or []
+
+        self.cpu_busy_peak = None  # Of the busiest core, 0-1
+        self.cpu_busy_mean = None
+        self.cpu_headroom = None  # 1 - 90th percentile of the busiest core
+        self.softirq_peak = None
+        self.mem_available_min = None  # kB
+        self.qdisc_drops = None  # Over the run, all sampled qdiscs
+        self.qdisc_marks = None
+        self.backlog_peak = None  # bytes
+
+        if len(self.samples) >= 2:
+            self._summarize()
+
+    def _summarize(self):
+        busiest = []
+        softirq = []
+        for before, after in zip(self.samples, self.samples[1:]):
+            fractions = cpu_fractions(before["cpu"], after["cpu"])
+            if fractions:
+                busiest.append(max(busy for busy, si in fractions.values()))
+                softirq.append(max(si for busy, si in fractions.values()))
+        if busiest:
+            self.cpu_busy_peak = max(busiest)
+            self.cpu_busy_mean = float(np.mean(busiest))
+            self.cpu_headroom = 1 - float(np.percentile(busiest, 90))
+            self.softirq_peak = max(softirq)
+
+        available = [s["meminfo"].get("MemAvailable", s["meminfo"].get("MemFree")) for s in self.samples]
+        available = [kb for kb in available if kb is not None]
+        if available:
+            self.mem_available_min = min(available)
+
+        first, last = self.samples[0]["qdiscs"], self.samples[-1]["qdiscs"]
+        shared = [name for name in last if name in first]
+        if shared:
+            self.qdisc_drops = sum(max(0, last[name]["dropped"] - first[name]["dropped"]) for name in shared)
+            self.qdisc_marks = sum(max(0, last[name]["marks"] - first[name]["marks"]) for name in shared)
+            self.backlog_peak = max(q["backlog_bytes"] for s in self.samples for q in s["qdiscs"].values())
+
+    def as_dict(self):
+        # The summary only; raw samples stay in memory
+        return {name: getattr(self, name) for name in self._fields}
+
+    @classmethod
+    def from_dict(cls, d):
+        summary = cls()
+        for name in cls._fields:
+            setattr(summary, name, d.get(name))
+        return summary
+
+    def __str__(self):
+        if self.cpu_busy_peak is None:
+            return "router: no samples"
+        out = f"router cpu {self.cpu_busy_peak * 100:.0f}%"
+        if self.softirq_peak is not None:
+            out += f", softirq {self.softirq_peak * 100:.0f}%"
+        if self.qdisc_drops is not None:
+            out += f", {self.qdisc_drops} drops"
+        if self.qdisc_marks is not None:
+            out += f", {self.qdisc_marks} marks"
+        return out
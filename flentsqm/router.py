@@ -24,46 +24,367 @@ THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
 OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 
+import atexit
+import os
+import shutil
 import subprocess
+import tempfile
+
+from flentsqm.timing import span
 
 
 class Router:
     
-    def __init__(self, ip="192.168.1.1", user="root"):
+    def __init__(self, ip="192.168.1.1", user="root", persist=True, control_persist=600):
         self._ip = ip
         self._user = user
-        
-    def run_cmd(self, cmd, print_output=False):
+
+        # One multiplexed ssh master per Router, so each command skips the handshake
+        self._persist = persist
+        self._control_persist = control_persist
+        self._control_dir = None
+        self._control_path = None
+        if self._persist:
+            self._control_dir = tempfile.mkdtemp(prefix="flentsqm-ssh-")
+            self._control_path = os.path.join(self._control_dir, "master.sock")
+            atexit.register(self.close)
+
+        # Cached "uci show" of the packages we touch, loaded on first use
+        self.cached_packages = ["sqm", "network"]
+        self._uci_cache = None
+
+        # Set when the running SQM instance no longer matches its UCI config
+        self._sqm_restart_pending = True
+
+        # Root qdisc kind the SQM script puts on each interface, until its config changes
+        self._shapers = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def destination(self):
+        return f"{self._user}@{self._ip}"
+
+    def _ssh_args(self):
+        if not self._persist:
+            return ["ssh", self.destination]
+        # ControlMaster=no falls back to a direct connection if the master is gone
+        return ["ssh", "-o", "ControlMaster=no", "-S", self._control_path, self.destination]
+
+    def _master_running(self):
+        if not self._control_path or not os.path.exists(self._control_path):
+            return False
+        sp = subprocess.run(["ssh", "-S", self._control_path, "-O", "check", self.destination],
+                            stdin=subprocess.DEVNULL, capture_output=True)
+        return sp.returncode == 0
+
+    def _start_master(self):
+        # -f backgrounds after authentication; its stdio must not be our pipes or run() never returns
+        with span("ssh master", "ssh connect"):
+            sp = subprocess.run(["ssh", "-M", "-N", "-f",
+                                 "-o", f"ControlPersist={self._control_persist}",
+                                 "-o", "ServerAliveInterval=5",
+                                 "-o", "ServerAliveCountMax=3",
+                                 "-S", self._control_path, self.destination],
+                                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if sp.returncode:
+            print(f"Unable to start ssh master for {self.destination} ({sp.returncode})")
+        return sp.returncode == 0
+
+    def _stop_master(self):
+        if self._control_path and os.path.exists(self._control_path):
+            subprocess.run(["ssh", "-S", self._control_path, "-O", "exit", self.destination],
+                           stdin=subprocess.DEVNULL, capture_output=True)
+
+    def connect(self):
+        if not self._persist:
+            return True
+        if self._master_running():
+            return True
+        self._stop_master()
+        return self._start_master()
+
+    def close(self):
+        if not self._persist:
+            return
+        self._stop_master()
+        if self._control_dir:
+            shutil.rmtree(self._control_dir, ignore_errors=True)
+            self._control_dir = None
+            self._control_path = None
+        self._persist = False
+
+    def run_cmd(self, cmd, print_output=False, input=None):
         if isinstance(cmd, str):
             cmd = cmd.split()
-        sp = subprocess.run(["ssh", f"{self._user}@{self._ip}"] + cmd, capture_output=True)
+        if isinstance(input, str):
+            input = input.encode('utf-8')
+        stdin = subprocess.DEVNULL if input is None else None
+        with span(' '.join(cmd)[:60], cmd_category(cmd)):
+            if self._persist and not os.path.exists(self._control_path):
+                self._start_master()
+            sp = subprocess.run(self._ssh_args() + cmd, stdin=stdin, input=input, capture_output=True)
+            if sp.returncode == 255 and self._persist:
+                # ssh itself failed, likely a stale master after the link dropped; reconnect and retry once
+                self._stop_master()
+                self._start_master()
+                sp = subprocess.run(self._ssh_args() + cmd, stdin=stdin, input=input, capture_output=True)
         if sp.stderr:
             print(sp.stderr.decode('utf-8'))
         if print_output:
             print(sp.stdout.decode('utf-8'))
         return sp
     
+    def open_channel(self, cmd):
+        # A long-running command whose output streams back as it comes, over the same master
+        if isinstance(cmd, str):
+            cmd = [cmd]
+        if self._persist and not os.path.exists(self._control_path):
+            self._start_master()
+        return subprocess.Popen(self._ssh_args() + cmd, stdin=subprocess.DEVNULL,
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+    def refresh(self):
+        cmd = []
+        for package in self.cached_packages:
+            if cmd:
+                cmd += [";"]
+            cmd += ["uci", "show", package]
+        sp = self.run_cmd(cmd)
+        if sp.returncode:
+            self._uci_cache = None
+            return None
+        self._uci_cache = parse_uci_show(sp.stdout.decode('utf-8'))
+        return self._uci_cache
+
+    def invalidate(self):
+        self._uci_cache = None
+        self._sqm_restart_pending = True
+        self._shapers = {}
+
+    def uci_get(self, key):
+        key = uci_key(key)
+        if key.split('.')[0] not in self.cached_packages:
+            return self.run_cmd(["uci", "-q", "get", key]).stdout.decode('utf-8').strip() or None
+        if self._uci_cache is None:
+            self.refresh()
+        if self._uci_cache is None:
+            return None
+        return self._uci_cache.get(key)
+
     def sqm_show(self, print_output=True):
         self.run_cmd("uci show sqm", print_output)
 
     def sqm_restart(self, print_output=False):
-        self.run_cmd("/etc/init.d/sqm restart", print_output)
+        sp = self.run_cmd("/etc/init.d/sqm restart", print_output)
+        if sp.returncode == 0:
+            self._sqm_restart_pending = False
+        return sp
+
+    def shaper(self, iface):
+        # "cake", "htb", ... or None without a shaper, asked once per interface and SQM config
+        if iface not in self._shapers:
+            sp = self.run_cmd(["tc", "qdisc", "show", "dev", iface])
+            self._shapers[iface] = shaper_qdisc(sp.stdout.decode('utf-8')) if sp.returncode == 0 else None
+        return self._shapers[iface]
+
+    def apply(self, changes, restart=False, print_output=False, then=None):
+        # One "uci batch" with one commit per package, then at most one SQM restart,
+        # all in a single ssh round trip. Bare option names are in the sqm.test section.
+        # Commands in then are chained after the commit, instead of a restart.
+        changes = {uci_key(key): value for key, value in changes.items()}
+        # Only send what actually differs from the router's current config
+        changes = {key: value for key, value in changes.items() if self.uci_get(key) != str(value)}
+        if not changes and not self._sqm_restart_pending:
+            restart = False
+            then = None
+        script = ''
+        packages = []
+        for key, value in changes.items():
+            script += f"set {key}={uci_quote(value)}\n"
+            package = key.split('.')[0]
+            if package not in packages:
+                packages.append(package)
+        for package in packages:
+            script += f"commit {package}\n"
+
+        cmd = []
+        if script:
+            cmd += ["uci", "batch"]
+        if restart:
+            then = ["/etc/init.d/sqm restart"]
+        for then_cmd in (then or []):
+            if cmd:
+                cmd += ["&&"]
+            cmd += then_cmd.split()
+        if not cmd:
+            return UciResult(changes, restarted=False)
+
+        sp = self.run_cmd(cmd, print_output, input=script or None)
+
+        if sp.returncode and script:
+            self.invalidate()
+        elif self._uci_cache is not None:
+            for key, value in changes.items():
+                self._uci_cache[key] = str(value)
+        # New rates reach the running shaper only through a restart, unless then retuned it live
+        retuned = then is not None and not restart and sp.returncode == 0
+        for key in changes:
+            if key.startswith("sqm.") and not (retuned and key in ("sqm.test.download", "sqm.test.upload")):
+                self._sqm_restart_pending = True
+        if any(key in changes for key in ("sqm.test.script", "sqm.test.qdisc", "sqm.test.interface",
+                                          "sqm.test.enabled")):
+            self._shapers = {}
+        if restart and sp.returncode == 0:
+            self._sqm_restart_pending = False
+
+        return UciResult(changes, restarted=restart, completed_process=sp)
+
+    def batch(self, restart=False, print_output=False):
+        return UciBatch(self, restart=restart, print_output=print_output)
 
     def sqm_enable(self, yes=True, print_output=False):
         if yes:
             state = 1
         else:
             state = 0
-        self.run_cmd(f"uci set sqm.test.enabled='{state}'")
-        self.run_cmd("uci commit")
-        self.sqm_restart(print_output)
+        return self.apply({"enabled": state}, restart=True, print_output=print_output)
 
     def sqm_set_params(self, interface, overhead):
-        self.run_cmd(f"uci set sqm.test.interface='{interface}'")
-        self.run_cmd(f"uci set sqm.test.overhead='{overhead}'")
-        self.run_cmd("uci commit")
+        return self.apply({"interface": interface, "overhead": overhead})
 
     def sqm_set_targets(self, download, upload):
-        self.run_cmd(f"uci set sqm.test.download='{download}'")
-        self.run_cmd(f"uci set sqm.test.upload='{upload}'")
-        self.run_cmd("uci commit")
+        return self.apply({"download": download, "upload": upload})
+
+    def sqm_change_rates(self, download, upload, print_output=False):
+        # Only the shaper rates changed: retune the running cake qdiscs in place rather than
+        # tearing down the qdiscs and IFB. Anything else pending needs the full restart, as do
+        # htb scripts such as simple.qos, which derive several class rates and bursts from the
+        # rates; a restart has the script set them up exactly as it would.
+        targets = {"download": download, "upload": upload}
+        iface = self.uci_get("sqm.test.interface")
+        if self._sqm_restart_pending or self.uci_get("sqm.test.enabled") != '1' or not iface \
+                or self.shaper(iface) != "cake":
+            return self.apply(targets, restart=True, print_output=print_output)
+
+        ifb = ifb_name(iface)
+        result = self.apply(targets, print_output=print_output,
+                            then=[f"tc qdisc change dev {iface} root cake bandwidth {upload}kbit",
+                                  f"tc qdisc change dev {ifb} root cake bandwidth {download}kbit"])
+        if not result.ok:
+            print(f"In-place rate change on {iface} failed, restarting SQM")
+            sp = self.sqm_restart(print_output)
+            result = UciResult(result.changes, restarted=True, completed_process=sp)
+        return result
+
+
+# Root qdiscs a bare interface can have; SQM replaces them with its shaper, cake or htb
+_default_root_qdiscs = {"noqueue", "mq", "pfifo_fast", "pfifo", "fq_codel", "fq"}
+
+
+def shaper_qdisc(tc_output):
+    # The shaping root qdisc in `tc qdisc show dev X` output, None when there is only a default one
+    for line in tc_output.splitlines():
+        fields = line.split()
+        if len(fields) >= 4 and fields[0] == "qdisc" and fields[3] == "root" \
+                and fields[1] not in _default_root_qdiscs:
+            return fields[1]
+    return None
+
+
+def ifb_name(iface):
+    # As sqm-scripts names the ingress IFB of an interface, limited to IFNAMSIZ
+    return f"ifb4{iface}"[:15]
+
+
+def cmd_category(cmd):
+    # For timing, what a router command is spent on
+    if "/etc/init.d/sqm" in cmd:
+        return "sqm restart"
+    if "uci" in cmd and "batch" in cmd:
+        return "uci commit"
+    if "tc" in cmd:
+        return "tc"
+    return "ssh"
+
+
+def uci_key(key, section="sqm.test"):
+    if '.' in key:
+        return key
+    return f"{section}.{key}"
+
+
+def parse_uci_show(text):
+    config = {}
+    for line in text.splitlines():
+        key, sep, value = line.partition('=')
+        if not sep:
+            continue
+        if len(value) >= 2 and value[0] == value[-1] == "'" and value.count("'") == 2:
+            value = value[1:-1]
+        config[key] = value
+    return config
+
+
+def uci_quote(value):
+    value = str(value).replace("'", "'\\''")
+    return f"'{value}'"
+
+
+class UciResult:
+
+    def __init__(self, changes, restarted=False, completed_process=None):
+        self.changes = changes
+        self.restarted = restarted
+        self.completed_process = completed_process
+
+    @property
+    def returncode(self):
+        if self.completed_process is None:
+            return 0
+        return self.completed_process.returncode
+
+    @property
+    def ok(self):
+        return self.returncode == 0
+
+    @property
+    def stdout(self):
+        if self.completed_process is None:
+            return ''
+        return self.completed_process.stdout.decode('utf-8')
+
+    @property
+    def stderr(self):
+        if self.completed_process is None:
+            return ''
+        return self.completed_process.stderr.decode('utf-8')
+
+
+class UciBatch:
+
+    def __init__(self, router: Router, restart=False, print_output=False):
+        self.router = router
+        self.restart = restart
+        self.print_output = print_output
+        self.changes = {}
+        self.result = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.apply()
+
+    def set(self, key, value):
+        self.changes[key] = value
+
+    def apply(self):
+        self.result = self.router.apply(self.changes, restart=self.restart, print_output=self.print_output)
+        self.changes = {}
+        return self.result
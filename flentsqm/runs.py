@@ -24,17 +24,23 @@ THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
 OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 
+import gzip
+import json
 import re
+import signal
 import subprocess
 import time
 
+import numpy as np
+
 from flentsqm.router import Router
-from flentsqm.stats import mean, stddev, coefvar
+from flentsqm.stats import SeriesStats, interval_means, mean
+from flentsqm.timing import span
 
 
 class FlentRun:
 
-    def __init__(self, flent_output_string, target=None):
+    def __init__(self, flent_output_string, target=None, data_file=None):
         self._flent_output_string = flent_output_string
 
         self._test = None
@@ -49,7 +55,26 @@ class FlentRun:
         self._download_data = []
         self._upload_data = []
 
-        self.target = target
+        # Raw per-series samples and metadata, only when read from the data file
+        self._metadata = {}
+        self._x_values = []
+        self._series = {}
+        self.source = None
+
+        # SeriesStats computed once per run, on first use
+        self._stats = {}
+
+        self.target = tuple(target) if isinstance(target, list) else target  # Lists from JSON
+        self.timestamp = time.time()
+        self.truncated = None  # Reason, if the run was stopped before flent finished
+        self.length = None  # flent -l seconds, None for the test's full default length
+        self.resources = None  # ResourceSummary of the router during the run, if sampled
+        self.invalid = None  # Reason flent produced no usable measurement; never counts toward a verdict
+        self.settle_time = None  # Seconds waited for the link and router to go quiet before the run
+        self.precision = None  # For a selected median run, how well its repeats pin down totals
+
+        # Formatted RunCollector rows, by marks and format
+        self.formatted_rows = {}
         self.marked_good = None
         self.marked_bad = None
         self.marked_selected = None
@@ -72,9 +97,88 @@ class FlentRun:
 
         self._re_totals = re.compile(" TCP totals.* : +([0-9]+\.[0-9]+)")
 
-        self.parse()
+        if data_file is None:
+            data_file = self._find_data_file()
+        if not (data_file and self.load_data_file(data_file)):
+            # Summary scraping is only the fallback, for when there is no readable data file
+            self.parse()
+            self.source = "stdout"
+
+    @classmethod
+    def from_data_file(cls, data_file, target=None, flent_output_string=''):
+        return cls(flent_output_string, target=target, data_file=data_file)
+
+    @classmethod
+    def from_data(cls, data, target=None, flent_output_string=''):
+        # From an already decoded flent data file, such as a simulated one
+        run = cls(flent_output_string, target=target)
+        run.parse_data(data)
+        run.source = "data"
+        return run
+
+    def _find_data_file(self):
+        for line in self._flent_output_string.splitlines():
+            m = self._re_data_file.match(line)
+            if m:
+                return m.group(1)
+        return None
+
+    def load_data_file(self, data_file):
+        try:
+            with span("load data file", "parse"):
+                with gzip.open(data_file, mode='rt', encoding='utf-8') as f:
+                    data = json.load(f)
+                self.parse_data(data, data_file=data_file)
+        except (OSError, EOFError, ValueError, KeyError, TypeError) as e:
+            print(f"Unable to read flent data file '{data_file}': {e}")
+            return False
+        self.source = "data_file"
+        return True
+
+    def parse_data(self, data, data_file=None):
+        self._metadata = data.get("metadata") or {}
+        self._x_values = data.get("x_values") or []
+        self._series = {}
+        self._stats = {}
+        # Missing samples stay as NaN so every series stays aligned with x_values
+        for name, values in data["results"].items():
+            self._series[name] = np.array(values, dtype=float)
+
+        self._data_file = data_file
+        self._test = self._metadata.get("NAME")
+        self._title = self._metadata.get("TITLE")
+
+        self._ping = self.series_stats("Ping (ms) ICMP").median
+
+        self._download_data = []
+        self._upload_data = []
+        for name in self._series:
+            if name.endswith((" sum", " avg", " fairness")):
+                continue
+            flow_mean = self.series_stats(name).mean
+            if flow_mean is None:
+                continue
+            if name.startswith("TCP download"):
+                self._download_data.append(flow_mean)
+            elif name.startswith("TCP upload"):
+                self._upload_data.append(flow_mean)
+
+        self._avg_download = self.series_stats("TCP download avg").mean or mean(self._download_data)
+        self._avg_upload = self.series_stats("TCP upload avg").mean or mean(self._upload_data)
+        self._sum_download = self.series_stats("TCP download sum").mean
+        if self._sum_download is None and self._download_data:
+            self._sum_download = sum(self._download_data)
+        self._sum_upload = self.series_stats("TCP upload sum").mean
+        if self._sum_upload is None and self._upload_data:
+            self._sum_upload = sum(self._upload_data)
+        self._totals = self.series_stats("TCP totals").mean
 
     def parse(self):
+        with span("parse summary", "parse"):
+            self._parse()
+
+    def _parse(self):
+        self._stats = {}
 
         for line in self._flent_output_string.splitlines():
 
@@ -137,6 +241,158 @@ class FlentRun:
     def data_file(self):
         return self._data_file
 
+    @property
+    def metadata(self):
+        return self._metadata
+
+    @property
+    def series(self):
+        return self._series
+
+    def series_stats(self, name):
+        if name not in self._stats:
+            self._stats[name] = SeriesStats(self._series.get(name))
+        return self._stats[name]
+
+    def _flow_stats(self, which):
+        # Stats across the per-flow means, as the CoV/sigma thresholds are defined
+        key = ("flows", which)
+        if key not in self._stats:
+            if which == "download":
+                data = self._download_data
+            elif which == "upload":
+                data = self._upload_data
+            else:
+                data = np.concatenate((np.asarray(self._upload_data, dtype=float),
+                                       np.asarray(self._download_data, dtype=float)))
+            self._stats[key] = SeriesStats(data)
+        return self._stats[key]
+
+    @property
+    def totals_series(self):
+        # Aggregate throughput per sample interval, from the raw data
+        if "TCP totals" in self._series:
+            return self._series["TCP totals"]
+        download = self._series.get("TCP download sum")
+        upload = self._series.get("TCP upload sum")
+        if download is not None and upload is not None:
+            return download + upload
+        if download is not None:
+            return download
+        if upload is not None:
+            return upload
+        return np.empty(0)
+
+    @property
+    def totals_stats(self):
+        return self.throughput_stats("both")
+
+    def throughput_stats(self, which):
+        # Stats over the aggregate throughput samples of one direction, or both, under load
+        key = ("throughput", which)
+        if key not in self._stats:
+            if which == "both":
+                y = self.totals_series
+            else:
+                y = self._series.get(f"TCP {which} sum")
+            if y is None or not len(y):
+                self._stats[key] = SeriesStats(None)
+            else:
+                x = np.asarray(self._x_values, dtype=float)
+                n = min(x.size, y.size)
+                start, end = self.load_window
+                window = (x[:n] >= start) & (x[:n] <= end)
+                self._stats[key] = SeriesStats(y[:n][window])
+        return self._stats[key]
+
+    @property
+    def coefvar_totals_series(self):
+        return self.totals_stats.coefvar
+
+    @property
+    def coefvar_download_series(self):
+        return self.throughput_stats("download").coefvar
+
+    @property
+    def coefvar_upload_series(self):
+        return self.throughput_stats("upload").coefvar
+
+    def throughput_by_interval(self, interval=1.0):
+        key = ("interval", interval)
+        if key not in self._stats:
+            self._stats[key] = interval_means(self._x_values, self.totals_series, interval)
+        return self._stats[key]
+
+    @property
+    def load_window(self):
+        # flent runs the load for LENGTH seconds, after and before DELAY seconds of idle
+        length = self._metadata.get("LENGTH")
+        total_length = self._metadata.get("TOTAL_LENGTH")
+        if length and total_length:
+            delay = (total_length - length) / 2
+        else:
+            delay = 5
+            length = length or (self._x_values[-1] - 2 * delay if self._x_values else 0)
+        return delay, delay + length
+
+    @property
+    def latency_series_names(self):
+        return [name for name in self._series if name.startswith("Ping (ms)") and not name.endswith(" avg")]
+
+    def latency_stats(self, under_load=True):
+        # All ICMP and UDP latency samples pooled, either under load or from the idle lead-in
+        key = ("latency", under_load)
+        if key not in self._stats:
+            x = np.asarray(self._x_values, dtype=float)
+            start, end = self.load_window
+            if under_load:
+                window = (x >= start) & (x <= end)
+            else:
+                window = x < start
+            samples = []
+            for name in self.latency_series_names:
+                n = min(x.size, self._series[name].size)
+                samples.append(self._series[name][:n][window[:n]])
+            self._stats[key] = SeriesStats(np.concatenate(samples) if samples else None)
+        return self._stats[key]
+
+    @property
+    def latency_p90(self):
+        return self.latency_stats().percentile(90)
+
+    @property
+    def latency_p99(self):
+        return self.latency_stats().percentile(99)
+
+    @property
+    def latency_max(self):
+        return self.latency_stats().max
+
+    @property
+    def latency_idle(self):
+        return self.latency_stats(under_load=False).median
+
+    @property
+    def latency_increase(self):
+        # Bufferbloat: median latency under load over the idle baseline
+        loaded = self.latency_stats().median
+        idle = self.latency_idle
+        if loaded is None or idle is None:
+            return None
+        return loaded - idle
+
+    @property
+    def target_download(self):
+        return split_target(self.target)[0]
+
+    @property
+    def target_upload(self):
+        return split_target(self.target)[1]
+
+    @property
+    def fidelity(self):
+        return "calibration" if self.length else "full"
+
     @property
     def test(self):
         return self._test
@@ -175,48 +431,39 @@ class FlentRun:
 
     @property
     def mean_download(self):
-        return mean(self._download_data)
+        return self._flow_stats("download").mean
 
     @property
     def mean_upload(self):
-        return mean(self._upload_data)
+        return self._flow_stats("upload").mean
 
     @property
     def mean_both(self):
-        both = self._upload_data.copy()
-        both.extend(self._download_data)
-        return mean(both)
+        return self._flow_stats("both").mean
 
     @property
     def stddev_download(self):
-        return stddev(self._download_data)
+        return self._flow_stats("download").stddev
 
     @property
     def stddev_upload(self):
-        return stddev(self._upload_data)
+        return self._flow_stats("upload").stddev
 
     @property
     def stddev_both(self):
-        both = self._upload_data.copy()
-        both.extend(self._download_data)
-        x = stddev(both)
-        if x is None:
-            print(self.__dict__)
-        return stddev(both)
+        return self._flow_stats("both").stddev
 
     @property
     def coefvar_download(self):
-        return coefvar(self._download_data)
+        return self._flow_stats("download").coefvar
 
     @property
     def coefvar_upload(self):
-        return coefvar(self._upload_data)
+        return self._flow_stats("upload").coefvar
 
     @property
     def coefvar_both(self):
-        both = self._upload_data.copy()
-        both.extend(self._download_data)
-        return coefvar(both)
+        return self._flow_stats("both").coefvar
 
     @property
     def flent_output_string(self):
@@ -230,15 +477,85 @@ class RunCollector:
         self._tunnel = tunnel
         self._test = test
         self.runs = []
+        self.selection = []  # Runs in the order passes selected them; a reused run can come up again
 
         self.sqm_fractional_threshold = 20
 
+        self.journal = None
+        self.journal_key = None
+
+        self._logged = {}  # logname: runs already written to it
+
+    @property
+    def device(self):
+        return self._device
+
+    @property
+    def tunnel(self):
+        return self._tunnel
+
+    @property
+    def test(self):
+        return self._test
+
+    def attach_journal(self, journal, key):
+        self.journal = journal
+        self.journal_key = key
+        journal.record_collector(key, self)
+
     def add(self, run):
         if not isinstance(run, FlentRun):
             raise TypeError(f"Can only add a FlentRun, not a {type(run)}")
         self.runs.append(run)
+        if self.journal:
+            self.journal.record_run(self.journal_key, run)
         return run
 
+    def select(self, run):
+        run.marked_selected = True
+        self.selection.append(run)
+        if self.journal:
+            self.journal.record_selection(self.journal_key, run)
+
+    @property
+    def last_selected(self):
+        # The latest pass's choice, which need not be the newest selected run
+        if self.selection:
+            return self.selection[-1]
+        selected = self.selected_runs
+        return selected[-1] if selected else None
+
+    def selection_rank(self, run):
+        # Position of the latest selection of run, later is higher, or None
+        ranks = [n for n, selected in enumerate(self.selection) if selected is run]
+        return ranks[-1] if ranks else None
+
+    def checkpoint(self):
+        # Journal any marks changed since the runs were added
+        if self.journal:
+            for run in self.runs:
+                self.journal.record_marks(run)
+
+    def runs_at(self, target, max_age=None, full_only=False):
+        now = time.time()
+        found = []
+        for run in self.runs:
+            if run.invalid:
+                continue
+            if run.target is None or target is None:
+                if run.target is not target:
+                    continue
+            elif any(abs(have - want) > 1e-6 for have, want in zip(split_target(run.target), split_target(target))):
+                continue
+            if self._test and run.test and run.test != self._test:
+                continue
+            if max_age is not None and now - run.timestamp > max_age:
+                continue
+            if full_only and run.fidelity != "full":
+                continue
+            found.append(run)
+        return found
+
     @property
     def selected_runs(self):
         selected = []
@@ -248,6 +565,17 @@ class RunCollector:
         return selected
 
     def dump_one(self, run: FlentRun, with_output_filename=True):
+        # Everything a row shows that can change after the run is made; indexed runs lack some of it
+        resources = getattr(run, "resources", None)
+        key = (run.marked_good, run.marked_bad, run.marked_selected, run.truncated, run.length,
+               getattr(run, "invalid", None), None if resources is None else str(resources),
+               getattr(run, "settle_time", None), getattr(run, "precision", None),
+               with_output_filename, self.sqm_fractional_threshold)
+        if key not in run.formatted_rows:
+            run.formatted_rows[key] = self._format_one(run, with_output_filename)
+        return run.formatted_rows[key]
+
+    def _format_one(self, run: FlentRun, with_output_filename=True):
         this_output = ''
         if run.marked_bad:
             this_output += " x"
@@ -255,8 +583,15 @@ class RunCollector:
             this_output += "=>"
         else:
             this_output += "  "
-        this_output += f"{run.totals:7.2f} Mbps  {run.ping:6.2f} ms  "
-        this_output += f"{run.coefvar_both * 100:6.2f} %   "
+        this_output += f"{run.totals:7.2f} Mbps  "
+        if run.ping is not None:
+            this_output += f"{run.ping:6.2f} ms  "
+        else:
+            this_output += f"{'':6s} ms  "
+        if run.coefvar_both is not None:
+            this_output += f"{run.coefvar_both * 100:6.2f} %   "
+        else:
+            this_output += f"{'':6s} %   "
         for try_cov in (run.coefvar_download, run.coefvar_upload):
             if try_cov is not None:
                 this_output += f"{try_cov * 100:6.2f} % "
@@ -265,11 +600,24 @@ class RunCollector:
         # TODO: Any option better than this hack?
         if run.target is None:
             this_output += "      None "
-        elif run.target < self.sqm_fractional_threshold:
-            this_output += f"{run.target:6.1f} Mbps"
         else:
-            this_output += f"{run.target:6d} Mbps"
-        this_output += f"    {run.stddev_both:.4f}"
+            this_output += f"{format_target(run.target, self.sqm_fractional_threshold):>6s} Mbps"
+        if run.stddev_both is not None:
+            this_output += f"    {run.stddev_both:.4f}"
+        else:
+            this_output += f"    {'':6s}"
+        if run.length:
+            this_output += f"  ({run.length} s calibration)"
+        if run.truncated:
+            this_output += f"  (stopped: {run.truncated})"
+        if getattr(run, "invalid", None):
+            this_output += f"  (invalid: {run.invalid})"
+        if getattr(run, "resources", None) is not None:
+            this_output += f"  ({run.resources})"
+        if getattr(run, "settle_time", None) is not None:
+            this_output += f"  (settled {run.settle_time:.1f} s)"
+        if getattr(run, "precision", None):
+            this_output += f"  ({run.precision})"
         if with_output_filename:
             this_output += f"\t{run.data_file}"
         this_output += "\n"
@@ -284,32 +632,106 @@ class RunCollector:
         return this_output
 
     def dump(self, sort=None, with_output_filename=True):
-        this_output = self.dump_header()
         if sort:
             the_runs = sorted(self.runs, key=sort)
         else:
             the_runs = self.runs
-        for run in the_runs:
-            this_output += self.dump_one(run, with_output_filename=with_output_filename)
+        rows = [self.dump_one(run, with_output_filename=with_output_filename) for run in the_runs]
 
-        return this_output
+        return self.dump_header() + ''.join(rows)
+
+    def write_log(self, logname, sort=None):
+        with open(logname, mode='w') as logfile:
+            print(self.dump(sort=sort), file=logfile)
+        self._logged[logname] = len(self.runs)
 
+    def append_log(self, logname):
+        # Append rows only for runs not yet in the log; returns those rows
+        if logname not in self._logged:
+            self.write_log(logname)
+            return self.dump(with_output_filename=False)
+        new_runs = self.runs[self._logged[logname]:]
+        with open(logname, mode='a') as logfile:
+            for run in new_runs:
+                logfile.write(self.dump_one(run))
+        self._logged[logname] = len(self.runs)
+        return ''.join(self.dump_one(run, with_output_filename=False) for run in new_runs)
 
-def execute_one_test(router: Router, sqm, dest_dir, host, test, title='', note=''):
+
+def split_target(target):
+    # (download, upload) of an SQM target, either one rate for both or a pair
+    if isinstance(target, (tuple, list)):
+        return tuple(target)
+    return target, target
+
+
+def make_target(download, upload):
+    # The pair, or just the one rate when they are the same
+    if download == upload:
+        return download
+    return download, upload
+
+
+def format_target(target, sqm_fractional_threshold=20):
+    if target is None:
+        return "None"
+    if isinstance(target, (tuple, list)):
+        return "/".join(format_target(rate, sqm_fractional_threshold) for rate in target)
+    if target < sqm_fractional_threshold:
+        return f"{target:0.1f}"
+    return f"{int(target)}" if target == int(target) else f"{target}"
+
+
+def execute_one_test(router: Router, sqm, dest_dir, host, test, title='', note='', monitor=None, length=None,
+                     sampler=None, settler=None):
 
     if sqm is not None:
-        router.sqm_set_targets(int(sqm*1000), int(sqm*1000))
+        download, upload = split_target(sqm)
+        router.sqm_change_rates(int(download*1000), int(upload*1000), print_output=True)
     else:
-        router.sqm_enable(yes=False)
-    router.sqm_restart(True)
+        router.apply({"enabled": 0}, restart=True, print_output=True)
 
-    print(f"Starting test: {note}")
+    # Let the previous run's traffic and the reconfiguration die down before measuring
+    settle_time = settler.wait() if settler else None
 
-    sp = subprocess.run(["flent", "-D", dest_dir, "-t", title, "-n", f'"{note}"',
-                         "-x", "-H", host, test],
-                        capture_output=True)
+    print(f"Starting test: {note}")
 
-    if sp.returncode or (sp.stderr and sp.stderr != b''):
+    args = ["flent", "-D", dest_dir, "-t", title, "-n", f'"{note}"', "-x", "-H", host]
+    if length:
+        args += ["-l", f"{length}"]
+    args += [test]
+
+    truncated = None
+    if sampler:
+        sampler.start()
+    with span(f"{test} {sqm}", "flent", target=sqm, test=test, length=length):
+        if monitor is None:
+            sp = subprocess.run(args, capture_output=True)
+        else:
+            # Stream the run, so a monitor that sees the outcome is settled can stop it early
+            proc = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            started = time.time()
+            while True:
+                try:
+                    stdout, stderr = proc.communicate(timeout=monitor.interval)
+                    break
+                except subprocess.TimeoutExpired:
+                    pass
+                with span("monitor", "monitor", concurrent=True):
+                    truncated = monitor.poll(time.time() - started)
+                if truncated:
+                    print(f"Stopping test early after {time.time() - started:.0f} s: {truncated}")
+                    proc.send_signal(signal.SIGINT)
+                    try:
+                        stdout, stderr = proc.communicate(timeout=30)
+                    except subprocess.TimeoutExpired:
+                        proc.kill()
+                        stdout, stderr = proc.communicate()
+                    break
+            sp = subprocess.CompletedProcess(args, proc.returncode, stdout, stderr)
+    resources = sampler.stop() if sampler else None
+
+    if not truncated and (sp.returncode or (sp.stderr and sp.stderr != b'')):
         nowstr = time.strftime("%Y-%m-%d_%H%M%S")
         print(f"flent returned {sp.returncode}")
         print(f"args: {sp.args}")
@@ -321,5 +743,14 @@ def execute_one_test(router: Router, sqm, dest_dir, host, test, title='', note='
             print(f"stdout:\n{sp.stdout.decode('utf-8')}", file=errfile)
 
     run = FlentRun(sp.stdout.decode('utf-8'), target=sqm)
+    run.truncated = truncated
+    run.length = length
+    run.resources = resources
+    run.settle_time = settle_time
+    if not truncated:
+        if sp.returncode:
+            run.invalid = f"flent returned {sp.returncode}"
+        elif not (run.download or run.upload):
+            run.invalid = "no throughput data"
 
     return run
@@ -0,0 +1,223 @@
+"""
+Copyright 2019 Jeff Klesky
+
+Redistribution and use in source and binary forms, with or without modification,
+are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright
+   notice, this list of conditions and the following disclaimer in the
+   documentation and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+"AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import contextlib
+import multiprocessing
+import os
+import queue
+import sys
+import time
+import traceback
+
+from flentsqm.controller import DEFAULT_HOSTS
+from flentsqm.health import TestbedUnhealthy
+from flentsqm.index import ResultsIndex
+from flentsqm.journal import Journal
+from flentsqm.naming import protect_for_filename
+from flentsqm.router import Router
+from flentsqm.sweep import Sweep
+from flentsqm.timing import tracer
+
+
+_direction_tests = ("tcp_8down", "tcp_8up")
+
+
+def shared_items(steps, asymmetric=False):
+    # A search needs its baseline from the same testbed, so work shared by several testbeds
+    # goes as whole ("item", tunnel, tests) items, in the order their steps first appear in the plan.
+    # An asymmetric rrul search starts from its tunnel's tcp_8down and tcp_8up results, so
+    # those go in one item with it.
+    items = []
+    for kind, tunnel, test in steps:
+        tests = (test,)
+        if asymmetric and test in _direction_tests + ("rrul",) \
+                and any(other[1:] == (tunnel, "rrul") for other in steps):
+            tests = tuple(t for t in _direction_tests + ("rrul",) if any(other[1:] == (tunnel, t) for other in steps))
+        if ("item", tunnel, tests) not in items:
+            items.append(("item", tunnel, tests))
+    return items
+
+
+class Testbed:
+    # One device under test, with its own router address and flent servers
+
+    def __init__(self, device, ip="192.168.1.1", user="root", hosts=None, name=None):
+        self.device = device
+        self.ip = ip
+        self.user = user
+        self.hosts = hosts or {}  # flent host by tunnel name, "None" for no tunnel
+        self.name = name or device
+
+    def __repr__(self):
+        return f"Testbed({self.name!r}, {self.user}@{self.ip})"
+
+    def host_for(self, tunnel):
+        # The flent server its runs through tunnel will use
+        key = "None" if tunnel is None or str(tunnel).lower() == "none" else tunnel
+        return self.hosts.get(key) or DEFAULT_HOSTS.get(key)
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d["device"], ip=d.get("ip", "192.168.1.1"), user=d.get("user", "root"),
+                   hosts=d.get("hosts"), name=d.get("name"))
+
+
+class DevicePool:
+    # Runs the (tunnel, test) items of each device on every testbed of that device at once.
+    # One process per testbed takes items from its device's queue, one at a time, so a
+    # testbed never runs two flent tests at once.
+
+    def __init__(self, testbeds, tunnels, tests, basedir=".", index_path=None, trace=False,
+                 steps=None, configure=None, asymmetric=False):
+        self.testbeds = list(testbeds)
+        self.tunnels = tunnels
+        self.tests = tests
+        self.basedir = basedir
+        self.index_path = index_path
+        self.index_updated = False  # Set where the caller has just brought the index up to date
+        self.trace = trace
+
+        # Planned (kind, tunnel, test) steps from flentsqm.plan, and a function to set up each Sweep
+        self.steps = steps
+        self.configure = configure
+        self.asymmetric = asymmetric  # Keeps each tunnel's rrul on the testbed that ran its direction tests
+
+        self.check()
+
+    def check(self):
+        # Testbeds that share a router or flent server would disturb each other's runs;
+        # those without hosts of their own all use the controllers' default servers
+        seen = {}
+        for testbed in self.testbeds:
+            hosts = {testbed.host_for(tunnel) for tunnel in self.tunnels} | set(testbed.hosts.values())
+            for what in [("name", testbed.name), ("router", f"{testbed.user}@{testbed.ip}")] + \
+                        [("flent host", host) for host in sorted(hosts - {None})]:
+                if what in seen and seen[what] is not testbed:
+                    raise ValueError(f"{testbed} and {seen[what]} share {what[0]} '{what[1]}'")
+                seen[what] = testbed
+
+    @property
+    def devices(self):
+        devices = []
+        for testbed in self.testbeds:
+            if testbed.device not in devices:
+                devices.append(testbed.device)
+        return devices
+
+    def work_items(self, device):
+        if self.steps is None:
+            return shared_items([("item", tunnel, test) for tunnel in self.tunnels for test in self.tests],
+                                self.asymmetric)
+        if len([testbed for testbed in self.testbeds if testbed.device == device]) == 1:
+            return list(self.steps)
+        return shared_items(self.steps, self.asymmetric)
+
+    def run(self):
+        context = multiprocessing.get_context("fork")
+        nowstr = time.strftime("%Y-%m-%d_%H%M")
+
+        if self.index_path and not self.index_updated:
+            ResultsIndex(self.index_path).update([self.basedir])
+
+        queues = {}
+        for device in self.devices:
+            queues[device] = context.Queue()
+            for step in self.work_items(device):
+                queues[device].put(step)
+
+        processes = {}
+        for testbed in self.testbeds:
+            sweep_dir = os.path.join(self.basedir, protect_for_filename(f"{testbed.name}_{nowstr}"))
+            os.mkdir(sweep_dir)
+            process = context.Process(target=run_testbed, name=testbed.name,
+                                      args=(testbed, sweep_dir, queues[testbed.device],
+                                            self.tunnels, self.tests, self.index_path, self.trace,
+                                            self.configure))
+            process.start()
+            processes[testbed.name] = (process, sweep_dir)
+            print(f"{testbed}: started, output in '{sweep_dir}'")
+
+        exitcodes = {}
+        for name, (process, sweep_dir) in processes.items():
+            process.join()
+            exitcodes[name] = process.exitcode
+            print(f"{name}: {'finished' if process.exitcode == 0 else f'failed ({process.exitcode})'},"
+                  f" see '{os.path.join(sweep_dir, 'sweep.log')}'")
+
+        for device, work in queues.items():
+            left = 0
+            while True:
+                try:
+                    work.get_nowait()
+                except queue.Empty:
+                    break
+                left += 1
+            if left:
+                print(f"{device}: {left} items not run, no testbed left for them")
+        return exitcodes
+
+
+def run_testbed(testbed: Testbed, sweep_dir, work, tunnels, tests, index_path=None, trace=False, configure=None):
+    # Worker process for one testbed; everything it prints goes to its own log
+    console = sys.__stdout__
+    if trace:
+        tracer.enable()
+
+    with open(os.path.join(sweep_dir, "sweep.log"), 'w', buffering=1) as log, \
+            contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+
+        router = Router(ip=testbed.ip, user=testbed.user)
+        journal = Journal(os.path.join(sweep_dir, "journal.jsonl"))
+        journal.record_sweep(device=testbed.device, tunnels=tunnels, tests=tests, testbed=testbed.name)
+        index = ResultsIndex(index_path) if index_path else None
+        sweep = Sweep(testbed.device, sweep_dir, router, journal, index=index, hosts=testbed.hosts)
+        if configure:
+            configure(sweep)
+
+        try:
+            while True:
+                try:
+                    step = work.get(timeout=1)
+                except queue.Empty:
+                    break
+                kind, tunnel, test = step
+                test = test if isinstance(test, str) else ' '.join(test)
+                print(f"{testbed.name}: {tunnel} {test}{'' if kind == 'item' else f' {kind}'}",
+                      file=console, flush=True)
+                sweep.run_step(step)
+        except TestbedUnhealthy as e:
+            print(e)
+            print(f"{testbed.name}: {e}", file=console, flush=True)
+            exit(3)
+        except BaseException:
+            traceback.print_exc()
+            print(f"{testbed.name}: failed, see its sweep.log", file=console, flush=True)
+            exit(1)
+        finally:
+            router.close()
+            if trace:
+                tracer.write(os.path.join(sweep_dir, "trace.json"))
+                print(tracer.summary(), end='')
@@ -0,0 +1,113 @@
+"""
+Copyright 2019 Jeff Klesky
+
+Redistribution and use in source and binary forms, with or without modification,
+are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright
+   notice, this list of conditions and the following disclaimer in the
+   documentation and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+"AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import shutil
+import time
+
+from flentsqm.monitor import ping_once
+from flentsqm.router import Router
+from flentsqm.timing import span
+
+
+class Settler:
+    # Waits, after the router is reconfigured and before the next run, until the link and
+    # router are idle again: ping back near its idle baseline, the router CPU quiet and no
+    # new connections still being tracked.
+    # Starts the run as soon as they are, rather than after a fixed sleep.
+
+    def __init__(self, router: Router, host, baseline=None):
+        self.router = router
+        self.host = host
+        self.baseline = baseline  # Idle ping in ms, lowered by whatever is seen quieter
+
+        self.interval = 0.5
+        self.timeout = 30
+        self.quiet_samples = 3  # In a row
+        self.ping_ratio = 1.5  # Of the baseline, plus ping_slack
+        self.ping_slack = 1.0  # ms
+        self.cpu_busy_limit = 0.2  # All CPUs together
+        # New conntrack entries allowed per sample. Old flows linger in the table for minutes,
+        # so only a growing count says something, such as a straggling netperf, is still opening them
+        self.conntrack_growth_limit = 2
+
+        self.last = None  # Details of the last wait, for the log
+
+        # Without ping here, the router CPU alone has to say when things are quiet
+        self.use_ping = shutil.which("ping") is not None
+
+    def read_router(self):
+        # (busy, total) jiffies over all CPUs, and the conntrack entries
+        sp = self.router.run_cmd(["head", "-1", "/proc/stat", ";",
+                                  "cat", "/proc/sys/net/netfilter/nf_conntrack_count"])
+        lines = sp.stdout.decode('utf-8').splitlines()
+        try:
+            fields = [int(x) for x in lines[0].split()[1:9]]
+        except (IndexError, ValueError):
+            return None, None
+        conntrack = int(lines[1]) if len(lines) > 1 and lines[1].strip().isdigit() else None
+        return (sum(fields) - fields[3] - fields[4], sum(fields)), conntrack
+
+    def wait(self):
+        # Seconds waited; gives up after timeout, as a busy link is no reason to stop the sweep
+        with span("settle", "settle"):
+            started = time.time()
+            quiet = 0
+            cpu_before, conntrack_before = self.read_router()
+            rtt = cpu_busy = conntrack = None
+            while True:
+                time.sleep(self.interval)
+                rtt = ping_once(self.host) if self.use_ping else None
+                cpu_after, conntrack = self.read_router()
+                cpu_busy = None
+                if cpu_before and cpu_after and cpu_after[1] > cpu_before[1]:
+                    cpu_busy = (cpu_after[0] - cpu_before[0]) / (cpu_after[1] - cpu_before[1])
+                cpu_before = cpu_after
+                conntrack_growth = None
+                if conntrack is not None and conntrack_before is not None:
+                    conntrack_growth = conntrack - conntrack_before
+                conntrack_before = conntrack
+
+                if rtt is not None and (self.baseline is None or rtt < self.baseline):
+                    self.baseline = rtt
+                ping_quiet = not self.use_ping or (rtt is not None
+                                                   and rtt <= self.baseline * self.ping_ratio + self.ping_slack)
+                cpu_quiet = cpu_busy is None or cpu_busy <= self.cpu_busy_limit
+                conntrack_quiet = conntrack_growth is None or conntrack_growth <= self.conntrack_growth_limit
+                quiet = quiet + 1 if ping_quiet and cpu_quiet and conntrack_quiet else 0
+
+                waited = time.time() - started
+                if quiet >= self.quiet_samples or waited >= self.timeout:
+                    break
+
+        self.last = {"waited": waited, "settled": quiet >= self.quiet_samples, "ping": rtt,
+                     "baseline": self.baseline, "cpu_busy": cpu_busy, "conntrack": conntrack,
+                     "conntrack_growth": conntrack_growth}
+        if quiet >= self.quiet_samples:
+            print(f"Settled in {waited:.1f} s")
+        else:
+            print(f"Not settled after {waited:.0f} s (ping {rtt} ms, baseline {self.baseline} ms,"
+                  f" cpu {cpu_busy}, conntrack {conntrack}), starting anyway")
+        return waited
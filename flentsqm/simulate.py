@@ -0,0 +1,289 @@
+"""
+Copyright 2019 Jeff Klesky
+
+Redistribution and use in source and binary forms, with or without modification,
+are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright
+   notice, this list of conditions and the following disclaimer in the
+   documentation and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+"AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import contextlib
+import io
+import math
+import random
+import subprocess
+
+import numpy as np
+
+from flentsqm.controller import DownPassController, UpPassController, BisectPassController
+from flentsqm.resources import ResourceSummary
+from flentsqm.router import Router
+from flentsqm.runs import FlentRun, RunCollector, split_target
+
+# Offline stand-ins for the router and flent, so the search strategies can be compared
+# over many devices in seconds rather than hours of 70 s runs
+
+
+TEST_FLOWS = {
+    "tcp_8down": {"download": 8},
+    "tcp_8up": {"upload": 8},
+    "rrul": {"download": 4, "upload": 4},
+}
+
+
+class DeviceModel:
+    # A CPU-limited router. Below ceiling * knee the shaper holds the flows fair and
+    # latency flat; past it the flows spread apart and latency climbs, as on real devices.
+
+    def __init__(self, ceiling, upload_ceiling=None, rrul_share=0.55,
+                 capacity_noise=0.03, sample_noise=0.05,
+                 knee=0.95, spread_base=0.003, spread_slope=0.15, unshaped_spread=0.05,
+                 base_latency=3.0, bloat_slope=200, unshaped_latency=80,
+                 shaper_efficiency=0.95, seed=None):
+        self.ceiling = ceiling  # Mbps
+        self.upload_ceiling = upload_ceiling or ceiling
+        self.rrul_share = rrul_share  # Of each ceiling, per direction, when loaded both ways
+
+        self.capacity_noise = capacity_noise  # Run to run
+        self.sample_noise = sample_noise  # Sample to sample, within a flow
+
+        self.knee = knee
+        self.spread_base = spread_base
+        self.spread_slope = spread_slope
+        self.unshaped_spread = unshaped_spread
+
+        self.base_latency = base_latency  # ms
+        self.bloat_slope = bloat_slope  # ms per unit of load past the knee
+        self.unshaped_latency = unshaped_latency
+
+        self.shaper_efficiency = shaper_efficiency
+
+        self.random = random.Random(seed)
+        self.np_random = np.random.default_rng(seed)
+
+        self.runs = 0
+        self.elapsed = 0  # Simulated seconds of flent, as a real sweep would spend
+        self.run_overhead = 10  # Router reconfiguration and flent start-up, per run
+
+    def __repr__(self):
+        return f"DeviceModel(ceiling={self.ceiling:.1f}, upload_ceiling={self.upload_ceiling:.1f})"
+
+    def capacity(self, test, direction):
+        ceiling = self.ceiling if direction == "download" else self.upload_ceiling
+        if len(TEST_FLOWS[test]) > 1:
+            ceiling *= self.rrul_share
+        return ceiling
+
+    def expected(self, test, direction, target, capacity=None):
+        # Noise-free (throughput, flow spread, latency) for one direction at a shaper target
+        capacity = capacity or self.capacity(test, direction)
+        if target is None:
+            return capacity, self.unshaped_spread, self.unshaped_latency
+        throughput = min(target * self.shaper_efficiency, capacity)
+        over = max(0, target / capacity - self.knee)
+        spread = self.spread_base + over * self.spread_slope
+        latency = min(self.base_latency + over * self.bloat_slope, self.unshaped_latency)
+        return throughput, spread, latency
+
+    def boundary(self, test, coefvar_limit=0.01, stddev_limit=0.02, sqm_fudge_factor=0.7):
+        # Highest target that passes the default success test without noise
+        best = None
+        for step in range(1, 3001):
+            target = step / 1000 * max(self.capacity(test, d) for d in TEST_FLOWS[test])
+            ok = True
+            for direction, flows in TEST_FLOWS[test].items():
+                throughput, spread, latency = self.expected(test, direction, target)
+                flow = throughput / flows
+                if spread >= coefvar_limit and spread * flow >= stddev_limit:
+                    ok = False
+                if throughput < target * sqm_fudge_factor:
+                    ok = False
+            if ok:
+                best = target
+        return best
+
+    def flent_data(self, test, target, title='', length=None):
+        step = 0.2
+        delay = 5
+        length = length or 60
+        total_length = length + 2 * delay
+        x = np.round(np.arange(0, total_length + step / 2, step), 1)
+        loaded = (x >= delay) & (x <= delay + length)
+
+        results = {}
+        worst_latency = self.base_latency
+        for direction, flows in TEST_FLOWS[test].items():
+            capacity = self.capacity(test, direction) * (1 + self.np_random.normal(0, self.capacity_noise))
+            rate = split_target(target)[0 if direction == "download" else 1]
+            throughput, spread, latency = self.expected(test, direction, rate, capacity)
+            worst_latency = max(worst_latency, latency)
+            name = f"TCP {direction}"
+            flow_means = throughput / flows * (1 + self.np_random.normal(0, spread, flows))
+            flow_sum = np.zeros(x.size)
+            for flow, flow_mean in enumerate(flow_means, start=1):
+                samples = flow_mean * (1 + self.np_random.normal(0, self.sample_noise, x.size))
+                samples = np.where(loaded, np.maximum(samples, 0), np.nan)
+                results[f"{name}::{flow}"] = samples
+                flow_sum = flow_sum + np.nan_to_num(samples)
+            results[f"{name} sum"] = np.where(loaded, flow_sum, np.nan)
+            results[f"{name} avg"] = results[f"{name} sum"] / flows
+
+        ping = np.where(loaded, worst_latency, self.base_latency)
+        results["Ping (ms) ICMP"] = ping * (1 + np.abs(self.np_random.normal(0, 0.1, x.size)))
+
+        # Lists with None for missing samples, as flent writes them
+        return {
+            "metadata": {"NAME": test, "TITLE": title, "LENGTH": length, "TOTAL_LENGTH": total_length,
+                         "STEP_SIZE": step, "SIMULATED": True},
+            "x_values": x.tolist(),
+            "results": {name: [None if math.isnan(v) else v for v in values.tolist()]
+                        for name, values in results.items()},
+        }
+
+    def cpu_busy(self, test, target):
+        # The busiest core, saturated once the shaper reaches the ceiling
+        busy = 0
+        for direction in TEST_FLOWS[test]:
+            rate = split_target(target)[0 if direction == "download" else 1]
+            throughput = self.expected(test, direction, rate)[0]
+            busy = max(busy, throughput / self.capacity(test, direction))
+        return min(1.0, busy)
+
+    def execute_one_test(self, router: Router, sqm, dest_dir, host, test, title='', note='',
+                         monitor=None, length=None, sampler=None, settler=None):
+        # Drop-in for flentsqm.runs.execute_one_test; a monitor cannot stop a simulated run early,
+        # and a simulated link is always quiet, so there is nothing to settle
+        if sqm is not None:
+            download, upload = split_target(sqm)
+            router.sqm_change_rates(int(download*1000), int(upload*1000))
+        else:
+            router.apply({"enabled": 0}, restart=True)
+
+        run = FlentRun.from_data(self.flent_data(test, sqm, title=title, length=length), target=sqm)
+        run.length = length
+        if sampler is not None:
+            busy = min(1.0, self.cpu_busy(test, sqm) * (1 + self.np_random.normal(0, self.capacity_noise)))
+            run.resources = ResourceSummary.from_dict({"cpu_busy_peak": busy, "cpu_busy_mean": busy,
+                                                       "cpu_headroom": 1 - busy, "softirq_peak": busy / 2})
+
+        self.runs += 1
+        self.elapsed += (length or 60) + 2 * 5 + self.run_overhead
+        return run
+
+
+class SimulatedRouter(Router):
+    # Answers uci and tc as a router would, from an in-memory config, and counts SQM restarts
+
+    def __init__(self, wan_ifname="eth1"):
+        super().__init__(persist=False)
+        self.config = {"network.wan.ifname": wan_ifname}
+        self.commands = 0
+        self.restarts = 0
+
+    def run_cmd(self, cmd, print_output=False, input=None):
+        if isinstance(cmd, str):
+            cmd = cmd.split()
+        if isinstance(input, bytes):
+            input = input.decode('utf-8')
+        self.commands += 1
+
+        stdout = ''
+        if cmd[:2] == ["uci", "show"]:
+            packages = {word for word in cmd[2:] if word not in ("uci", "show", ";")}
+            stdout = ''.join(f"{key}='{value}'\n" for key, value in sorted(self.config.items())
+                             if key.split('.')[0] in packages)
+        if cmd[:3] == ["tc", "qdisc", "show"] and self.config.get("sqm.test.enabled") == "1":
+            # The cake scripts put cake at the root, simple.qos and simplest.qos htb
+            kind = "htb" if "simple" in self.config.get("sqm.test.script", "") else "cake"
+            stdout = f"qdisc {kind} 8001: root refcnt 2\n"
+        if input:
+            for line in input.splitlines():
+                words = line.split(None, 1)
+                if len(words) == 2 and words[0] == "set":
+                    key, value = words[1].split('=', 1)
+                    self.config[key] = value.strip("'")
+        if "/etc/init.d/sqm" in cmd and "restart" in cmd:
+            self.restarts += 1
+        return subprocess.CompletedProcess(cmd, 0, stdout.encode('utf-8'), b'')
+
+
+STRATEGIES = ["chain", "chain-sequential", "bisect", "bisect-sequential", "bisect-calibration"]
+
+
+def run_strategy(strategy, model: DeviceModel, test="tcp_8down", quiet=True):
+    # Search one simulated device as perform_all_tests.py would, returning
+    # (selected target, runs, simulated seconds)
+    router = SimulatedRouter()
+    collector = RunCollector(device=repr(model), tunnel=None, test=test)
+    runs_before = model.runs
+    elapsed_before = model.elapsed
+
+    def configure(controller):
+        controller.execute_test = model.execute_one_test
+        controller.preflight = None
+        if strategy.endswith("-sequential"):
+            controller.use_sequential_decision()
+        if strategy.endswith("-calibration"):
+            controller.calibration_length = 15
+        return controller
+
+    kw = dict(run_collector=collector, router=router, device=repr(model), test=test, tunnel=None,
+              destdir=None, logname=None)
+
+    output = io.StringIO() if quiet else None
+    with contextlib.redirect_stdout(output) if quiet else contextlib.nullcontext():
+        start_at = int(model.execute_one_test(router, None, None, None, test).totals * 2)
+
+        if strategy.startswith("chain"):
+            configure(DownPassController(factor=0.7, start_at=start_at, **kw)).start()
+            for factor in (1.15, 1.05):
+                if collector.last_selected is None:
+                    break
+                configure(UpPassController(factor=factor, start_at=collector.last_selected.target,
+                                           **kw)).start()
+        elif strategy.startswith("bisect"):
+            configure(BisectPassController(start_at=start_at, **kw)).start()
+        else:
+            raise ValueError(f"Unknown strategy '{strategy}'")
+
+    selected = collector.last_selected.target if collector.last_selected else None
+    return selected, model.runs - runs_before, model.elapsed - elapsed_before
+
+
+def random_device(rng: random.Random, low=5, high=1000):
+    # Ceilings spread evenly in log space, from slow ARM to x86 class
+    ceiling = math.exp(rng.uniform(math.log(low), math.log(high)))
+    return DeviceModel(ceiling, seed=rng.randrange(2**32))
+
+
+def benchmark(strategies=None, devices=50, test="tcp_8down", seed=1):
+    # Same devices, and the same noise sequence, for every strategy
+    strategies = strategies or STRATEGIES
+    results = {strategy: [] for strategy in strategies}
+    for strategy in strategies:
+        rng = random.Random(seed)
+        for n in range(devices):
+            model = random_device(rng)
+            boundary = model.boundary(test)
+            selected, runs, elapsed = run_strategy(strategy, model, test)
+            error = (selected / boundary - 1) if selected and boundary else None
+            results[strategy].append({"device": model, "boundary": boundary, "selected": selected,
+                                      "runs": runs, "elapsed": elapsed, "error": error})
+    return results
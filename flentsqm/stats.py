@@ -24,25 +24,177 @@ THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
 OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 
-import statistics
+import math
+from statistics import NormalDist
+
+import numpy as np
+
+
+def as_samples(data):
+    # Float array with missing (None/NaN) samples dropped
+    if data is None:
+        raise TypeError("No data")
+    values = np.asarray(data, dtype=float).ravel()
+    return values[~np.isnan(values)]
+
+
+class SeriesStats:
+
+    def __init__(self, data):
+        try:
+            self.values = as_samples(data)
+        except (TypeError, ValueError):
+            self.values = np.empty(0)
+        self.count = self.values.size
+
+        self.mean = float(self.values.mean()) if self.count else None
+        self.stddev = float(self.values.std(ddof=1)) if self.count >= 2 else None
+        if self.stddev is not None and self.mean:
+            self.coefvar = self.stddev / self.mean
+        else:
+            self.coefvar = None
+
+        self._sorted = None
+        self._percentiles = {}
+
+    def percentile(self, p):
+        if not self.count:
+            return None
+        if p not in self._percentiles:
+            if self._sorted is None:
+                self._sorted = np.sort(self.values)
+            # Sorted once, so each further percentile is just an interpolation
+            position = (self.count - 1) * p / 100
+            lower = math.floor(position)
+            upper = min(lower + 1, self.count - 1)
+            fraction = position - lower
+            self._percentiles[p] = float(self._sorted[lower] * (1 - fraction) + self._sorted[upper] * fraction)
+        return self._percentiles[p]
+
+    @property
+    def median(self):
+        return self.percentile(50)
+
+    @property
+    def min(self):
+        return self.percentile(0)
+
+    @property
+    def max(self):
+        return self.percentile(100)
 
 
 def mean(data):
-    try:
-        return statistics.mean(data)
-    except (statistics.StatisticsError, TypeError):
-        return None
+    return SeriesStats(data).mean
+
+
+def median(data):
+    return SeriesStats(data).median
 
 
 def stddev(data):
-    try:
-        return statistics.stdev(data)
-    except (statistics.StatisticsError, TypeError):
-        return None
+    return SeriesStats(data).stddev
 
 
 def coefvar(data):
+    return SeriesStats(data).coefvar
+
+
+def interval_means(x_values, y_values, interval):
+    # Mean of y over consecutive x bins of width interval, skipping missing samples
     try:
-        return stddev(data)/statistics.mean(data)
-    except (statistics.StatisticsError, ZeroDivisionError, TypeError):
-        return None
\ No newline at end of file
+        x = np.asarray(x_values, dtype=float)
+        y = np.asarray(y_values, dtype=float)
+    except (TypeError, ValueError):
+        return np.empty(0)
+    n = min(x.size, y.size)
+    x = x[:n]
+    y = y[:n]
+    valid = ~(np.isnan(x) | np.isnan(y))
+    if not valid.any():
+        return np.empty(0)
+    bins = np.floor((x[valid] - x[valid].min()) / interval).astype(int)
+    counts = np.bincount(bins)
+    sums = np.bincount(bins, weights=y[valid])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return sums / counts
+
+
+def sprt_bounds(alpha, beta):
+    # Wald's thresholds on the log-likelihood ratio: (accept, reject)
+    return math.log((1 - beta) / alpha), math.log(beta / (1 - alpha))
+
+
+def sprt_llr(success, p_good, p_bad):
+    # Log-likelihood ratio contributed by one Bernoulli outcome
+    if success:
+        return math.log(p_good / p_bad)
+    else:
+        return math.log((1 - p_good) / (1 - p_bad))
+
+
+def t_quantile(p, df):
+    # Student's t quantile; exact for one and two degrees of freedom, otherwise
+    # the Cornish-Fisher expansion about the normal, within 0.1 % from three on
+    if df == 1:
+        return math.tan(math.pi * (p - 0.5))
+    if df == 2:
+        return (2 * p - 1) * math.sqrt(2 / (4 * p * (1 - p)))
+    z = NormalDist().inv_cdf(p)
+    return (z
+            + (z**3 + z) / (4 * df)
+            + (5 * z**5 + 16 * z**3 + 3 * z) / (96 * df**2)
+            + (3 * z**7 + 19 * z**5 + 17 * z**3 - 15 * z) / (384 * df**3)
+            + (79 * z**9 + 776 * z**7 + 1482 * z**5 - 1920 * z**3 - 945 * z) / (92160 * df**4))
+
+
+def mean_interval(data, confidence=0.95):
+    # (low, high) t-interval of the mean, None with fewer than two samples
+    values = as_samples(data)
+    n = values.size
+    if n < 2:
+        return None
+    half = t_quantile((1 + confidence) / 2, n - 1) * values.std(ddof=1) / math.sqrt(n)
+    return float(values.mean() - half), float(values.mean() + half)
+
+
+def median_interval(data, confidence=0.95):
+    # (low, high) distribution-free interval of the median from order statistics, so one
+    # outlying run cannot widen it much; None until there are enough samples to reach confidence
+    values = np.sort(as_samples(data))
+    n = values.size
+    k = None
+    tail = 0
+    for j in range(n // 2):
+        # Chance the median lies below the (j+1)th smallest sample
+        tail += math.comb(n, j) / 2 ** n
+        if 1 - 2 * tail < confidence:
+            break
+        k = j + 1
+    if k is None:
+        return None
+    return float(values[k - 1]), float(values[n - k])
+
+
+def relative_interval_width(data, estimator="median", confidence=0.95):
+    # Width of the confidence interval of the estimator over its value, or None if not yet known.
+    # Too few samples for the median's own interval falls back to the mean's, widened by the
+    # median's sqrt(pi/2) larger standard error for normal samples
+    values = as_samples(data)
+    if estimator == "median":
+        interval = median_interval(values, confidence)
+        if interval is None:
+            interval = mean_interval(values, confidence)
+            if interval is not None:
+                centre = float(np.median(values))
+                half = (interval[1] - interval[0]) / 2 * math.sqrt(math.pi / 2)
+                interval = centre - half, centre + half
+        centre = float(np.median(values)) if values.size else None
+    elif estimator == "mean":
+        interval = mean_interval(values, confidence)
+        centre = float(values.mean()) if values.size else None
+    else:
+        raise ValueError(f"Unknown estimator '{estimator}', not median or mean")
+    if interval is None or not centre:
+        return None
+    return (interval[1] - interval[0]) / centre
@@ -0,0 +1,251 @@
+"""
+Copyright 2019 Jeff Klesky
+
+Redistribution and use in source and binary forms, with or without modification,
+are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright
+   notice, this list of conditions and the following disclaimer in the
+   documentation and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+"AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import os
+
+from flentsqm.controller import DownPassController, UpPassController, MultiRunController, BisectPassController, \
+    CoordinatePassController
+from flentsqm.journal import Journal
+from flentsqm.naming import protect_for_filename
+from flentsqm.router import Router
+from flentsqm.runs import RunCollector, split_target
+from flentsqm.timing import span
+
+
+class Sweep:
+    # The pass chain perform_all_tests.py runs for each (tunnel, test) of one device,
+    # journaled in basedir so it can be resumed
+
+    def __init__(self, device, basedir, router: Router, journal: Journal, collectors=None, index=None, hosts=None):
+        self.device = device
+        self.basedir = basedir
+        self.router = router
+        self.journal = journal
+        self.collectors = collectors if collectors is not None else {}
+        self.index = index  # ResultsIndex for warm starts, if any
+
+        # flent host by tunnel name ("None" for no tunnel), for testbeds not on the default addresses
+        self.hosts = hosts or {}
+
+        # "updown" for the down then up passes, or "bisect"
+        self.chain = "updown"
+        self.median_runs = 5  # Or {"precision": 0.02, ...} for MultiRunController.use_adaptive_runs()
+        self.ping_limit = 10  # A ping pass follows when the selected run's ping is over this
+
+        # Search download and upload rates separately for tests loading both ways, starting
+        # from the tcp_8down and tcp_8up results when this sweep has them
+        self.asymmetric = False
+
+        # PassController attributes to set on every controller, then per test
+        self.controller_settings = {}
+        self.test_settings = {}
+
+    def collector_for(self, key, tunnel, test):
+        if key not in self.collectors:
+            self.collectors[key] = RunCollector(device=self.device, tunnel=tunnel, test=test)
+            self.collectors[key].attach_journal(self.journal, key)
+        return self.collectors[key]
+
+    def configure(self, controller):
+        host = self.hosts.get(controller.tunnel or "None")
+        if host:
+            controller.host = host
+        for settings in (self.controller_settings, self.test_settings.get(controller.test, {})):
+            for key, value in settings.items():
+                if key == "sequential":
+                    if value:
+                        controller.use_sequential_decision(**(value if isinstance(value, dict) else {}))
+                elif hasattr(controller, key) and not callable(getattr(controller, key)):
+                    setattr(controller, key, value)
+                else:
+                    raise ValueError(f"Unknown controller setting '{key}'")
+        return controller
+
+    def run_pass(self, controller, name):
+        controller.name = name
+        if self.journal.pass_complete(controller.collected.journal_key, name):
+            print(f"Already completed: {controller.collected.journal_key} {name}")
+            return
+        with span(name, "pass", device=self.device, tunnel=controller.tunnel, test=controller.test):
+            controller.start()
+
+    def destdir_for(self, tunnel):
+        destdir = os.path.join(self.basedir,
+                               protect_for_filename(tunnel or "None"))
+
+        try:
+            os.mkdir(destdir)
+        except FileExistsError as e:
+            pass
+
+        return destdir
+
+    def run_median(self, tunnel, test):
+        destdir = self.destdir_for(tunnel)
+
+        rc = self.collector_for(f"{tunnel}/{test}", tunnel, test)
+        median_pass = MultiRunController(run_collector=rc,
+                                         router=self.router, device=self.device, test=test, tunnel=tunnel,
+                                         destdir=destdir, logname=f"{destdir}/{test}.log",
+                                         runs=5 if isinstance(self.median_runs, dict) else self.median_runs,
+                                         sqm=None)
+        if isinstance(self.median_runs, dict):
+            median_pass.use_adaptive_runs(**self.median_runs)
+        self.run_pass(self.configure(median_pass), "median")
+
+    def run_search(self, tunnel, test):
+        device = self.device
+        router = self.router
+        destdir = self.destdir_for(tunnel)
+
+        rc = self.collector_for(f"{tunnel}/{test}", tunnel, test)
+        start_next = int(rc.last_selected.totals * 2)
+
+        rc_sqm = self.collector_for(f"{tunnel}/{test}_sqm", tunnel, test)
+
+        warm_pass = None
+        if self.index:
+            # An asymmetric result is refined per direction, rather than from its download rate alone
+            prior = self.index.last_selected_target(device, tunnel, test)
+            warm_class = CoordinatePassController if isinstance(prior, tuple) else BisectPassController
+            warm_pass = warm_class(run_collector=rc_sqm,
+                                   router=router, device=device, test=test, tunnel=tunnel,
+                                   destdir=destdir, logname=f"{destdir}/{test}_sqm.log",
+                                   start_at=start_next)
+            if warm_pass.warm_start(self.index) is None:
+                warm_pass = None
+
+        seed = self.direction_seed(tunnel) if self.asymmetric and test == "rrul" else None
+
+        if seed:
+            coordinate_pass = CoordinatePassController(run_collector=rc_sqm,
+                                                       router=router, device=device, test=test, tunnel=tunnel,
+                                                       destdir=destdir, logname=f"{destdir}/{test}_sqm.log",
+                                                       start_at=seed)
+            self.run_pass(self.configure(coordinate_pass), "coordinate")
+
+        elif warm_pass:
+            self.run_pass(self.configure(warm_pass), "warm")
+
+        elif self.chain == "bisect":
+            bisect_pass = BisectPassController(run_collector=rc_sqm,
+                                               router=router, device=device, test=test, tunnel=tunnel,
+                                               destdir=destdir, logname=f"{destdir}/{test}_sqm.log",
+                                               start_at=start_next)
+            self.run_pass(self.configure(bisect_pass), "bisect")
+
+        else:
+            down_pass = DownPassController(run_collector=rc_sqm,
+                                           router=router, device=device, test=test, tunnel=tunnel,
+                                           destdir=destdir, logname=f"{destdir}/{test}_sqm.log",
+                                           start_at=start_next)
+            self.run_pass(self.configure(down_pass), "down")
+
+            start_next = rc_sqm.last_selected.target
+
+            up_pass1 = UpPassController(run_collector=rc_sqm,
+                                        router=router, device=device, test=test, tunnel=tunnel,
+                                        destdir=destdir, logname=f"{destdir}/{test}_sqm.log",
+                                        factor=1.15, start_at=start_next)
+            self.run_pass(self.configure(up_pass1), "up1")
+
+            start_next = rc_sqm.last_selected.target
+
+            up_pass2 = UpPassController(run_collector=rc_sqm,
+                                        router=router, device=device, test=test, tunnel=tunnel,
+                                        destdir=destdir, logname=f"{destdir}/{test}_sqm.log",
+                                        factor=1.05, start_at=start_next)
+            self.run_pass(self.configure(up_pass2), "up2")
+
+        if self.asymmetric and test == "rrul" and not seed and not isinstance(warm_pass, CoordinatePassController):
+            # No per-direction results to start from, so refine the symmetric result instead
+            coordinate_pass = CoordinatePassController(run_collector=rc_sqm,
+                                                       router=router, device=device, test=test, tunnel=tunnel,
+                                                       destdir=destdir, logname=f"{destdir}/{test}_sqm.log",
+                                                       start_at=rc_sqm.last_selected.target, rounds=1)
+            coordinate_pass.trust_start = True
+            self.run_pass(self.configure(coordinate_pass), "coordinate")
+
+        ping_limit = self.ping_limit
+        if ping_limit and isinstance(rc_sqm.last_selected.target, tuple):
+            if rc_sqm.last_selected.ping > ping_limit:
+                # Back each rate off in turn, until ping is within the limit
+                ping_pass = CoordinatePassController(run_collector=rc_sqm,
+                                                     router=router, device=device, test=test, tunnel=tunnel,
+                                                     destdir=destdir, logname=f"{destdir}/{test}_sqm.log",
+                                                     start_at=rc_sqm.last_selected.target, factor=1.05,
+                                                     rounds=1)
+                self.configure(ping_pass)
+                ping_pass.ping_limit = ping_limit
+                ping_pass.target_failure_requires = 2
+
+                self.run_pass(ping_pass, "ping")
+
+        elif ping_limit and rc_sqm.last_selected.ping > ping_limit:
+            start_next = rc_sqm.last_selected.target
+
+            ping_pass = DownPassController(run_collector=rc_sqm,
+                                           router = router, device = device, test = test, tunnel = tunnel,
+                                           destdir=destdir, logname=f"{destdir}/{test}_sqm.log",
+                                           factor=0.95, start_at=start_next)
+            self.configure(ping_pass)
+            ping_pass.ping_limit = ping_limit
+            ping_pass.target_failure_requires = 2
+
+            self.run_pass(ping_pass, "ping")
+
+    def direction_seed(self, tunnel):
+        # (download, upload) selected by this sweep's tcp_8down and tcp_8up searches
+        seed = []
+        for test in ("tcp_8down", "tcp_8up"):
+            rc = self.collectors.get(f"{tunnel}/{test}_sqm")
+            if rc is None or rc.last_selected is None:
+                print(f"No {test} result for {tunnel} in this sweep to seed the asymmetric rrul search from;"
+                      f" searching symmetrically, then refining per direction")
+                return None
+            seed.append(split_target(rc.last_selected.target)[0 if test == "tcp_8down" else 1])
+        return tuple(seed)
+
+    def run_item(self, tunnel, test):
+        self.run_median(tunnel, test)
+        self.run_search(tunnel, test)
+
+    def run_step(self, step):
+        # A step of a flentsqm.plan plan, (kind, tunnel, test), or a shared
+        # ("item", tunnel, tests) of flentsqm.scheduler.shared_items()
+        kind, tunnel, test = step
+        if kind == "median":
+            self.run_median(tunnel, test)
+        elif kind == "search":
+            self.run_search(tunnel, test)
+        else:
+            for item_test in ((test,) if isinstance(test, str) else test):
+                self.run_item(tunnel, item_test)
+
+    def run(self, tunnels, tests):
+        for tunnel in tunnels:
+            for test in tests:
+                self.run_item(tunnel, test)
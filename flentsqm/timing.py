@@ -0,0 +1,149 @@
+"""
+Copyright 2019 Jeff Klesky
+
+Redistribution and use in source and binary forms, with or without modification,
+are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright
+   notice, this list of conditions and the following disclaimer in the
+   documentation and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+"AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import contextlib
+import csv
+import json
+import os
+import time
+
+
+class Span:
+
+    def __init__(self, name, category, labels, parent=None, concurrent=False):
+        self.name = name
+        self.category = category
+        self.labels = labels
+        self.parent = parent
+        # Runs alongside its parent, e.g. monitoring while flent runs, so takes nothing from it
+        self.concurrent = concurrent or (parent is not None and parent.concurrent)
+        self.start = time.time()
+        self.duration = 0
+        self.exclusive = 0  # Less the time spent in nested spans
+
+
+class Tracer:
+    # Wall-clock spans of where a sweep spends its time. Nested spans inherit
+    # the labels (device, tunnel, test, target) of the span they run inside.
+
+    def __init__(self):
+        self.enabled = False
+        self.spans = []
+        self._stack = []
+
+    def enable(self):
+        self.enabled = True
+
+    @contextlib.contextmanager
+    def span(self, name, category, concurrent=False, **labels):
+        if not self.enabled:
+            yield None
+            return
+        parent = self._stack[-1] if self._stack else None
+        merged = dict(parent.labels) if parent else {}
+        merged.update(labels)
+        span = Span(name, category, merged, parent, concurrent)
+        self._stack.append(span)
+        started = time.perf_counter()
+        try:
+            yield span
+        finally:
+            span.duration = time.perf_counter() - started
+            span.exclusive += span.duration
+            if parent and not (span.concurrent and not parent.concurrent):
+                parent.exclusive -= span.duration
+            self._stack.pop()
+            self.spans.append(span)
+
+    def write_chrome_trace(self, path):
+        # Loads in chrome://tracing or https://ui.perfetto.dev
+        events = []
+        for span in sorted(self.spans, key=lambda s: s.start):
+            events.append({"name": span.name, "cat": span.category, "ph": "X",
+                           "ts": round(span.start * 1e6), "dur": round(span.duration * 1e6),
+                           "pid": os.getpid(), "tid": 2 if span.concurrent else 1,
+                           "args": {key: str(value) for key, value in span.labels.items()}})
+        with open(path, 'w') as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+    def write_csv(self, path):
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(["start", "duration", "exclusive", "category", "name", "labels"])
+            for span in sorted(self.spans, key=lambda s: s.start):
+                writer.writerow([f"{span.start:.6f}", f"{span.duration:.6f}", f"{span.exclusive:.6f}",
+                                 span.category, span.name, json.dumps(span.labels, default=str)])
+
+    def write(self, path):
+        if path.endswith(".csv"):
+            self.write_csv(path)
+        else:
+            self.write_chrome_trace(path)
+
+    def summary(self, measurement=("flent",)):
+        # Measurement is the time flent is running; everything else is overhead
+        if not self.spans:
+            return "No timing recorded\n"
+        wall = max(s.start + s.duration for s in self.spans) - min(s.start for s in self.spans)
+        by_category = {}
+        for span in self.spans:
+            category = f"{span.category} *" if span.concurrent else span.category
+            count, total, exclusive = by_category.get(category, (0, 0, 0))
+            by_category[category] = (count + 1, total + span.duration, exclusive + span.exclusive)
+        measured = sum(by_category[c][2] for c in measurement if c in by_category)
+        untraced = wall - sum(exclusive for category, (count, total, exclusive) in by_category.items()
+                              if not category.endswith(" *"))
+
+        out = f"Sweep time {format_duration(wall)}: measurement {format_duration(measured)}"
+        out += f" ({measured / wall * 100 if wall else 0:.0f}%), overhead {format_duration(wall - measured)}"
+        out += f" ({(wall - measured) / wall * 100 if wall else 0:.0f}%)\n"
+        out += f"    {'Category':<16s} {'count':>6s} {'total':>10s} {'self':>10s} {'self %':>7s}\n"
+        for category, (count, total, exclusive) in sorted(by_category.items(), key=lambda kv: -kv[1][2]):
+            out += (f"    {category:<16s} {count:6d} {format_duration(total):>10s}"
+                    f" {format_duration(exclusive):>10s} {exclusive / wall * 100 if wall else 0:6.1f}%\n")
+        out += f"    {'(untraced)':<16s} {'':6s} {'':10s} {format_duration(untraced):>10s}"
+        out += f" {untraced / wall * 100 if wall else 0:6.1f}%\n"
+        if any(category.endswith(" *") for category in by_category):
+            out += "    * alongside flent, not part of the sweep time\n"
+        return out
+
+
+def format_duration(seconds):
+    if seconds < 60:
+        return f"{seconds:.2f} s"
+    minutes, seconds = divmod(round(seconds), 60)
+    if minutes < 60:
+        return f"{minutes}m {seconds:02d}s"
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h {minutes:02d}m"
+
+
+# The one tracer for this process, off until enable()
+tracer = Tracer()
+
+
+def span(name, category, concurrent=False, **labels):
+    return tracer.span(name, category, concurrent=concurrent, **labels)
@@ -24,88 +24,97 @@ THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
 OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 
+import argparse
+import atexit
 import os
-import sys
 import time
 
-from flentsqm.controller import DownPassController, UpPassController, MultiRunController
+from flentsqm.health import TestbedUnhealthy
+from flentsqm.index import ResultsIndex
+from flentsqm.journal import Journal
 from flentsqm.naming import protect_for_filename
-from flentsqm.runs import RunCollector
 from flentsqm.router import Router
-
-try:
-    device = sys.argv[1]
-except IndexError:
-    print(f"Usage: {sys.argv[0]} 'Device Name'")
+from flentsqm.sweep import Sweep
+from flentsqm.timing import tracer
+
+parser = argparse.ArgumentParser()
+parser.add_argument("device", nargs='?', help="'Device Name', not needed with --resume")
+parser.add_argument("--resume", metavar="DIR", help="continue the interrupted sweep in DIR from its journal")
+parser.add_argument("--warm-start", metavar="INDEX",
+                    help="start each SQM search near the last selected target in this results index")
+parser.add_argument("--asymmetric", action="store_true",
+                    help="search rrul download and upload rates separately, from the tcp_8down and tcp_8up results")
+parser.add_argument("--median-precision", metavar="FRACTION", type=float,
+                    help="repeat unshaped runs until the median's confidence interval is this narrow, e.g. 0.02,"
+                         " rather than always five times")
+parser.add_argument("--settle", action="store_true",
+                    help="before each run, wait for ping and router CPU to return to idle instead of starting at once")
+parser.add_argument("--trace", metavar="FILE",
+                    help="write a timeline of the sweep, Chrome trace JSON or .csv, and summarize where the time went")
+args = parser.parse_args()
+
+if not args.device and not args.resume:
+    print(f"Usage: {parser.prog} 'Device Name'")
     exit(1)
 
 tunnels = [None, "WireGuard", "OpenVPN"]
 tests = ["tcp_8down", "tcp_8up", "rrul"]
 
 start_at = 2000
-router = Router()
 
-nowstr = time.strftime("%Y-%m-%d_%H%M")
-basedir = protect_for_filename(f"{device}_{nowstr}")
+if args.trace:
+    tracer.enable()
 
-try:
-    os.mkdir(basedir)
-except FileExistsError as e:
-    print(f"Output directory '{basedir}' already exists. Wait a minute and try again.")
-    exit(1)
+    def write_trace():
+        tracer.write(args.trace)
+        print(tracer.summary(), end='')
+        print(f"Timeline written to '{args.trace}'")
+
+    # Also when the sweep is interrupted or exits early
+    atexit.register(write_trace)
 
-for tunnel in tunnels:
+router = Router()
 
-    destdir = os.path.join(basedir,
-                           protect_for_filename(tunnel or "None"))
+if args.resume:
+    basedir = args.resume
+    journal = Journal(os.path.join(basedir, "journal.jsonl"))
+    recorded, collectors = journal.load()
+    device = recorded.get("device", args.device)
+    if not device:
+        print(f"No journal to resume in '{basedir}'")
+        exit(1)
+    print(f"Resuming {device} in '{basedir}' with {sum(len(c.runs) for c in collectors.values())} runs")
+
+else:
+    device = args.device
+    nowstr = time.strftime("%Y-%m-%d_%H%M")
+    basedir = protect_for_filename(f"{device}_{nowstr}")
 
     try:
-        os.mkdir(destdir)
+        os.mkdir(basedir)
     except FileExistsError as e:
-        pass
+        print(f"Output directory '{basedir}' already exists. Wait a minute and try again.")
+        exit(1)
 
-    for test in tests:
+    journal = Journal(os.path.join(basedir, "journal.jsonl"))
+    journal.record_sweep(device=device, tunnels=tunnels, tests=tests)
+    collectors = {}
 
-        rc = RunCollector(device=device, tunnel=tunnel, test=test)
-        median_pass = MultiRunController(run_collector=rc,
-                                         router=router, device=device, test=test, tunnel=tunnel,
-                                         destdir=destdir, logname=f"{destdir}/{test}.log", sqm=None)
-        median_pass.start()
 
-        start_next = int(rc.selected_runs[-1].totals * 2)
+index = None
+if args.warm_start:
+    index = ResultsIndex(args.warm_start)
+    index.update(["."])
 
-        rc_sqm = RunCollector(device=device, tunnel=tunnel, test=test)
-        down_pass = DownPassController(run_collector=rc_sqm,
-                                       router=router, device=device, test=test, tunnel=tunnel,
-                                       destdir=destdir, logname=f"{destdir}/{test}_sqm.log",
-                                       start_at=start_next)
-        down_pass.start()
 
-        start_next = rc_sqm.selected_runs[-1].target
-
-        up_pass1 = UpPassController(run_collector=rc_sqm,
-                                    router=router, device=device, test=test, tunnel=tunnel,
-                                    destdir=destdir, logname=f"{destdir}/{test}_sqm.log",
-                                    factor=1.15, start_at=start_next)
-        up_pass1.start()
-
-        start_next = rc_sqm.selected_runs[-1].target
-
-        up_pass2 = UpPassController(run_collector=rc_sqm,
-                                    router=router, device=device, test=test, tunnel=tunnel,
-                                    destdir=destdir, logname=f"{destdir}/{test}_sqm.log",
-                                    factor=1.05, start_at=start_next)
-        up_pass2.start()
-
-        ping_limit = 10
-        if rc_sqm.selected_runs[-1].ping > ping_limit:
-            start_next = rc_sqm.selected_runs[-1].target
-
-            ping_pass = DownPassController(run_collector=rc_sqm,
-                                           router = router, device = device, test = test, tunnel = tunnel,
-                                           destdir=destdir, logname=f"{destdir}/{test}_sqm.log",
-                                           factor=0.95, start_at=start_next)
-            ping_pass.ping_limit = ping_limit
-            ping_pass.target_failure_requires = 2
-
-            ping_pass.start()
+sweep = Sweep(device, basedir, router, journal, collectors=collectors, index=index)
+sweep.asymmetric = args.asymmetric
+if args.median_precision:
+    sweep.median_runs = {"precision": args.median_precision}
+if args.settle:
+    sweep.controller_settings["settle"] = True
+try:
+    sweep.run(tunnels, tests)
+except TestbedUnhealthy as e:
+    print(e)
+    exit(3)
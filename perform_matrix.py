@@ -0,0 +1,81 @@
+"""
+Copyright 2019 Jeff Klesky
+
+Redistribution and use in source and binary forms, with or without modification,
+are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright
+   notice, this list of conditions and the following disclaimer in the
+   documentation and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+"AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import argparse
+
+from flentsqm.index import ResultsIndex
+from flentsqm.plan import MatrixConfig
+from flentsqm.scheduler import DevicePool
+
+# Matrix file, JSON. Everything but "testbeds" is optional, shown with its default
+# where it has one. "controller" and the per-test settings are PassController attributes,
+# plus "sequential": true (or {"alpha": ..., "beta": ..., "max_runs": ...}).
+#
+# {"testbeds": [{"device": "EA8300", "ip": "192.168.1.1",
+#                "hosts": {"None": "10.0.0.2", "WireGuard": "172.16.0.2", "OpenVPN": "172.16.1.2"}}],
+#  "tunnels": [null, "WireGuard", "OpenVPN"],
+#  "tests": ["tcp_8down", "tcp_8up", {"name": "rrul", "latency_p99_limit": 50}],
+#  "chain": "updown",
+#  "asymmetric": false,
+#  "median_runs": 5,  (or {"precision": 0.02, "min_runs": 3, "max_runs": 11} to stop once the median is that tight)
+#  "ping_limit": 10,
+#  "controller": {"coefvar_limit": 0.01, "stddev_limit": 0.02, "sqm_fudge_factor": 0.7},
+#  "estimate": {"run_seconds": 75, "restart_seconds": 10}}
+
+parser = argparse.ArgumentParser(description="Plan and run a test matrix from a config file")
+parser.add_argument("config", help="JSON matrix file")
+parser.add_argument("--plan-only", action="store_true", help="show the plan and estimate, then stop")
+parser.add_argument("--warm-start", metavar="INDEX",
+                    help="results index to warm start searches from, and to estimate run counts with")
+parser.add_argument("--trace", action="store_true", help="write trace.json in each testbed's output directory")
+args = parser.parse_args()
+
+try:
+    config = MatrixConfig.load(args.config)
+except (OSError, ValueError, KeyError) as e:
+    print(f"Unable to read '{args.config}': {e}")
+    exit(1)
+
+index = None
+if args.warm_start:
+    index = ResultsIndex(args.warm_start)
+    index.update(["."])
+
+print(config.describe(index), end='')
+if args.plan_only:
+    exit(0)
+
+try:
+    device_pool = DevicePool(config.testbeds, tunnels=config.tunnels, tests=config.tests,
+                             index_path=args.warm_start, trace=args.trace,
+                             steps=config.plan(), configure=config.configure, asymmetric=config.asymmetric)
+except ValueError as e:
+    print(e)
+    exit(1)
+device_pool.index_updated = index is not None
+
+exitcodes = device_pool.run()
+exit(1 if any(exitcodes.values()) else 0)
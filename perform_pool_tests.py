@@ -0,0 +1,64 @@
+"""
+Copyright 2019 Jeff Klesky
+
+Redistribution and use in source and binary forms, with or without modification,
+are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright
+   notice, this list of conditions and the following disclaimer in the
+   documentation and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+"AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import argparse
+import json
+
+from flentsqm.scheduler import DevicePool, Testbed
+
+# Pool file, JSON:
+#
+# {"tunnels": [null, "WireGuard", "OpenVPN"],
+#  "tests": ["tcp_8down", "tcp_8up", "rrul"],
+#  "testbeds": [
+#     {"device": "EA8300", "ip": "192.168.1.1",
+#      "hosts": {"None": "10.0.0.2", "WireGuard": "172.16.0.2", "OpenVPN": "172.16.1.2"}},
+#     {"device": "Archer C7", "ip": "192.168.2.1",
+#      "hosts": {"None": "10.0.1.2", "WireGuard": "172.16.2.2", "OpenVPN": "172.16.3.2"}}]}
+#
+# Testbeds of the same device share its work; give each one a distinct "name".
+
+parser = argparse.ArgumentParser(description="Sweep several testbeds at once")
+parser.add_argument("pool", help="JSON file of testbeds, and optionally tunnels and tests")
+parser.add_argument("--warm-start", metavar="INDEX",
+                    help="start each SQM search near the last selected target in this results index")
+parser.add_argument("--trace", action="store_true", help="write trace.json in each testbed's output directory")
+args = parser.parse_args()
+
+with open(args.pool) as f:
+    pool = json.load(f)
+
+try:
+    device_pool = DevicePool([Testbed.from_dict(d) for d in pool["testbeds"]],
+                             tunnels=pool.get("tunnels", [None, "WireGuard", "OpenVPN"]),
+                             tests=pool.get("tests", ["tcp_8down", "tcp_8up", "rrul"]),
+                             index_path=args.warm_start, trace=args.trace)
+except ValueError as e:
+    print(e)
+    exit(1)
+
+exitcodes = device_pool.run()
+exit(1 if any(exitcodes.values()) else 0)
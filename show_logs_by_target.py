@@ -24,53 +24,26 @@ THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
 OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 
-import os
-import re
-import sys
+import argparse
 
-try:
-    basedir = sys.argv[1]
-except IndexError:
-    basedir = None
+from flentsqm.index import ResultsIndex, dump_rows
 
+parser = argparse.ArgumentParser()
+parser.add_argument("roots", nargs='*', default=["."],
+                    help="result directories, or directories containing them (default: current directory)")
+parser.add_argument("--index", default="flentsqm_index.sqlite", help="SQLite index to use and update")
+parser.add_argument("--device")
+parser.add_argument("--tunnel")
+parser.add_argument("--test")
+parser.add_argument("--target", type=float)
+parser.add_argument("--since", help="YYYY-MM-DD")
+parser.add_argument("--until", help="YYYY-MM-DD")
+args = parser.parse_args()
 
-tunnels = ["None", "WireGuard", "OpenVPN"]
-lognames = [
-    "tcp_8down.log",
-    "tcp_8up.log",
-    "rrul.log",
-    "tcp_8down_sqm.log",
-    "tcp_8up_sqm.log",
-    "rrul_sqm.log",
-             ]
+index = ResultsIndex(args.index)
+index.update(args.roots)
 
-re_get_throughput = re.compile("^.*?([0-9.]+) Mbps.*?([0-9.]+) Mbps")
+rows = index.query(device=args.device, tunnel=args.tunnel, test=args.test, target=args.target,
+                   since=args.since, until=args.until and f"{args.until} 99:99")
 
-for tunnel in tunnels:
-    for logname in lognames:
-        filename = os.path.join(tunnel, logname)
-        if basedir:
-            filename = os.path.join(basedir, filename)
-        try:
-            with open(filename, 'r') as log:
-                print(f"{filename}\n")
-                runs = []
-                for line in log:
-                    match = re_get_throughput.match(line)
-                    if not match:
-                        if line.find("\t") >= 0:
-                            print(line.split("\t")[0])
-                        else:
-                            print(line, end='')
-                    else:
-                        runs.append({"throughput": match.group(1),
-                                     "target": match.group(2),
-                                     "line": line})
-
-            runs.sort(key=lambda r: float(r["target"]))
-            for run in runs:
-                print(run["line"].split("\t")[0])
-
-            print("\n")
-        except FileNotFoundError:
-            print(f"=====> Missing: {filename}")
+print(dump_rows(rows, sort=lambda row: (row["target"] or 0, row["totals"])), end='')
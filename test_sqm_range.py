@@ -29,6 +29,7 @@ import sys
 import time
 
 from flentsqm.controller import DownPassController
+from flentsqm.health import TestbedUnhealthy
 from flentsqm.naming import protect_for_filename
 from flentsqm.runs import RunCollector
 from flentsqm.router import Router
@@ -83,5 +84,9 @@ for tunnel in tunnels:
                              router=router, device=device, test=test, tunnel=tunnel,
                              destdir=destdir, logname=f"{destdir}/{test}_sqm.log")
 
-        down_pass.start()
+        try:
+            down_pass.start()
+        except TestbedUnhealthy as e:
+            print(e)
+            exit(3)
 
@@ -0,0 +1,17 @@
+from flentsqm.runs import FlentRun, RunCollector
+
+
+def test_rows_follow_changes_to_a_run():
+    collector = RunCollector(device="device", tunnel="None", test="tcp_8down")
+    run = FlentRun('', target=100)
+    collector.add(run)
+    assert "invalid" not in collector.dump_one(run)
+
+    run.invalid = "no data"
+    assert "(invalid: no data)" in collector.dump_one(run)
+
+    run.settle_time = 2.5
+    assert "(settled 2.5 s)" in collector.dump_one(run)
+
+    run.precision = "±1.0 % at 95 %"
+    assert "(±1.0 % at 95 %)" in collector.dump_one(run)
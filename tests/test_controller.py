@@ -0,0 +1,25 @@
+import pytest
+
+from flentsqm.controller import PassController
+from flentsqm import health
+from flentsqm.runs import FlentRun, RunCollector
+
+
+def invalid_run(**kwargs):
+    run = FlentRun('', target=kwargs.get("sqm"))
+    run.invalid = "no data"
+    return run
+
+
+def test_giving_up_raises_instead_of_exiting():
+    pc = PassController(RunCollector(), None, "device", "tcp_8down", "WireGuard", "/tmp", "log")
+    pc.current_target = 100
+    pc.preflight = None
+    pc.execute_test = invalid_run
+    pc.retry_backoff = 0
+    pc.after_run = lambda run: None
+
+    with pytest.raises(health.TestbedUnhealthy, match="after 3 attempts: no data"):
+        pc.execute_with_retry(sqm=100)
+    assert pc.runs_invalid == 3
+    assert len(pc.collected.runs) == 3
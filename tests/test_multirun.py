@@ -0,0 +1,28 @@
+from flentsqm.controller import MultiRunController
+from flentsqm.runs import RunCollector
+from flentsqm.simulate import DeviceModel, SimulatedRouter
+
+
+def multi_run(model, **adaptive):
+    mrc = MultiRunController(RunCollector(), SimulatedRouter(), "device", "tcp_8down", None, "/tmp", None)
+    mrc.execute_test = model.execute_one_test
+    mrc.preflight = None
+    mrc.after_run = lambda run: None
+    mrc.dump_summary = lambda: None
+    mrc.record_state = lambda: None
+    if adaptive:
+        mrc.use_adaptive_runs(**adaptive)
+    mrc.start()
+    return mrc
+
+
+def test_every_run_is_counted():
+    model = DeviceModel(300)
+    mrc = multi_run(model)
+    assert mrc.runs_executed == model.runs == 5
+
+
+def test_adaptive_runs_are_counted():
+    model = DeviceModel(300, capacity_noise=0.2)
+    mrc = multi_run(model, precision=0.001, min_runs=3, max_runs=9)
+    assert mrc.runs_executed == model.runs == 9
@@ -0,0 +1,86 @@
+from flentsqm.resources import ResourceSummary, parse_sample
+
+# tc -s qdisc show dev eth1, with layer_cake.qos: one column per diffserv3 tin
+CAKE = """\
+qdisc cake 8005: root refcnt 2 bandwidth 95Mbit diffserv3 triple-isolate nonat nowash no-ack-filter split-gso rtt 100ms noatm overhead 22 
+ Sent {bytes} bytes {packets} pkt (dropped {dropped}, overlimits 1720 requeues 0) 
+ backlog 4542b 3p requeues 0
+ memory used: 206080b of 4750000b
+ capacity estimate: 95Mbit
+ min/max network layer size:           28 /    1500
+ min/max overhead-adjusted size:       50 /    1522
+ average network hdr offset:           14
+
+                   Bulk  Best Effort        Voice
+  thresh       5937Kbit       95Mbit    23750Kbit
+  target          5.0ms        5.0ms        5.0ms
+  interval      100.0ms      100.0ms      100.0ms
+  pk_delay          0us        1.2ms         89us
+  av_delay          0us        412us         11us
+  sp_delay          0us         17us          3us
+  backlog            0b        4542b           0b
+  pkts                0        92188           40
+  bytes               0    134531688         3280
+  way_inds            0            0            0
+  way_miss            0           11            2
+  way_cols            0            0            0
+  drops               0           {dropped}            0
+  marks               0           {marks}            1
+  ack_drop            0            0            0
+  sp_flows            0            1            1
+  bk_flows            0            1            0
+  un_flows            0            0            0
+  max_len             0        68130           82
+  quantum           300         1514          724
+"""
+
+# tc -s qdisc show dev eth1, with simple.qos: htb classes each with an fq_codel leaf
+FQ_CODEL = """\
+qdisc htb 1: root refcnt 2 r2q 10 default 0x12 direct_packets_stat 0 direct_qlen 1000
+ Sent {bytes} bytes {packets} pkt (dropped {dropped}, overlimits 23085 requeues 0) 
+ backlog 0b 0p requeues 0
+qdisc fq_codel 110: parent 1:11 limit 1001p flows 1024 quantum 300 target 5ms interval 100ms memory_limit 4Mb ecn drop_batch 64 
+ Sent 3280 bytes 40 pkt (dropped 0, overlimits 0 requeues 0) 
+ backlog 0b 0p requeues 0
+  maxpacket 82 drop_overlimit 0 new_flow_count 39 ecn_mark 0
+  new_flows_len 1 old_flows_len 0
+qdisc fq_codel 120: parent 1:12 limit 1001p flows 1024 quantum 300 target 5ms interval 100ms memory_limit 4Mb ecn drop_batch 64 
+ Sent {bytes} bytes {packets} pkt (dropped {dropped}, overlimits 0 requeues 0) 
+ backlog 0b 0p requeues 0
+  maxpacket 1514 drop_overlimit 0 new_flow_count 1021 ecn_mark {marks} drop_overmemory 0
+  new_flows_len 0 old_flows_len 8
+qdisc fq_codel 130: parent 1:13 limit 1001p flows 1024 quantum 300 target 5ms interval 100ms memory_limit 4Mb ecn drop_batch 64 
+ Sent 0 bytes 0 pkt (dropped 0, overlimits 0 requeues 0) 
+ backlog 0b 0p requeues 0
+  maxpacket 0 drop_overlimit 0 new_flow_count 0 ecn_mark 0
+  new_flows_len 0 old_flows_len 0
+"""
+
+
+def sample(tc_output, **counters):
+    lines = ["@@dev eth1"] + tc_output.format(**counters).splitlines()
+    return parse_sample(lines)
+
+
+def test_cake_marks_sum_over_tins():
+    qdiscs = sample(CAKE, bytes=134534968, packets=92228, dropped=7, marks=25)["qdiscs"]
+    cake = qdiscs["eth1 cake 8005"]
+    assert cake["marks"] == 26
+    assert cake["dropped"] == 7
+    assert cake["backlog_bytes"] == 4542
+
+
+def test_fq_codel_marks_inline_with_other_counters():
+    qdiscs = sample(FQ_CODEL, bytes=134531688, packets=92188, dropped=3, marks=42)["qdiscs"]
+    assert qdiscs["eth1 fq_codel 120"]["marks"] == 42
+    assert qdiscs["eth1 fq_codel 110"]["marks"] == 0
+    assert qdiscs["eth1 htb 1"]["marks"] == 0
+
+
+def test_summary_counts_marks_over_the_run():
+    for tc_output in (CAKE, FQ_CODEL):
+        before = sample(tc_output, bytes=1000, packets=10, dropped=1, marks=5)
+        after = sample(tc_output, bytes=134531688, packets=92188, dropped=4, marks=47)
+        summary = ResourceSummary([before, after])
+        assert summary.qdisc_marks == 42
+        assert summary.qdisc_drops == (6 if tc_output is FQ_CODEL else 3)
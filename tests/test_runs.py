@@ -0,0 +1,61 @@
+import numpy as np
+
+from flentsqm.controller import PassController
+from flentsqm.runs import FlentRun, RunCollector
+
+
+def flent_data(flow_samples, step=0.2, delay=5):
+    # A tcp_8down data file with the same samples for every flow, loaded between the idle periods
+    length = len(flow_samples) * step
+    x = np.round(np.arange(0, length + 2 * delay, step), 1)
+    loaded = (x >= delay) & (x < delay + length)
+    flow = np.full(x.size, np.nan)
+    flow[loaded] = flow_samples
+    results = {f"TCP download::{n}": flow for n in range(1, 9)}
+    results["TCP download sum"] = flow * 8
+    results["TCP download avg"] = flow
+    results["Ping (ms) ICMP"] = np.full(x.size, 5.0)
+    return {
+        "metadata": {"NAME": "tcp_8down", "TITLE": "", "LENGTH": length, "TOTAL_LENGTH": length + 2 * delay},
+        "x_values": x.tolist(),
+        "results": {name: [None if np.isnan(v) else float(v) for v in values] for name, values in results.items()},
+    }
+
+
+def controller(target):
+    pc = PassController(RunCollector(), None, "device", "tcp_8down", "WireGuard", "/tmp", "log")
+    pc.current_target = target
+    return pc
+
+
+def test_flow_means_agree_on_steady_and_bursty_runs():
+    steady = FlentRun.from_data(flent_data([12.5] * 300), target=100)
+    bursty = FlentRun.from_data(flent_data([5.0, 20.0] * 150), target=100)
+    assert steady.coefvar_download == 0
+    assert bursty.coefvar_download == 0
+    assert steady.download == bursty.download == 100
+    assert steady.coefvar_download_series == 0
+    assert bursty.coefvar_download_series > 0.5
+
+
+def test_throughput_samples_decide_the_gate():
+    bursty = FlentRun.from_data(flent_data([5.0, 20.0] * 150), target=100)
+    pc = controller(100)
+    assert not pc.run_successful_test(bursty)
+    assert pc.run_margin(bursty) < 0
+
+    # The per-flow means alone would pass the same run
+    pc.series_coefvar_limit = None
+    assert pc.run_successful_test(bursty)
+
+
+def test_steady_run_passes():
+    steady = FlentRun.from_data(flent_data([12.5] * 300), target=100)
+    assert controller(100).run_successful_test(steady)
+
+
+def test_series_stats_ignore_idle_periods():
+    run = FlentRun.from_data(flent_data([12.5] * 300), target=100)
+    assert run.throughput_stats("download").count == 300
+    assert run.throughput_stats("upload").count == 0
+    assert run.coefvar_upload_series is None
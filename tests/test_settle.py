@@ -0,0 +1,48 @@
+from types import SimpleNamespace
+
+from flentsqm.settle import Settler
+
+
+class FakeRouter:
+    # /proc/stat always idle, while conntrack counts the given entries, then stays at the last
+    def __init__(self, conntrack):
+        self.conntrack = list(conntrack)
+        self.reads = 0
+
+    def run_cmd(self, cmd, print_output=False, input=None):
+        count = self.conntrack[min(self.reads, len(self.conntrack) - 1)]
+        self.reads += 1
+        jiffies = self.reads * 100
+        stdout = f"cpu  0 0 0 {jiffies} 0 0 0 0 0 0\n{count}\n"
+        return SimpleNamespace(returncode=0, stdout=stdout.encode('utf-8'))
+
+
+def settler(router):
+    s = Settler(router, "10.0.0.2")
+    s.use_ping = False
+    s.interval = 0
+    return s
+
+
+def test_settles_at_once_on_a_quiet_router():
+    router = FakeRouter([500])
+    s = settler(router)
+    s.wait()
+    assert s.last["settled"]
+    assert router.reads == 1 + s.quiet_samples
+
+
+def test_waits_while_connections_are_still_opening():
+    router = FakeRouter([500, 540, 580, 620, 620])
+    s = settler(router)
+    s.wait()
+    assert s.last["settled"]
+    assert s.last["conntrack"] == 620
+    assert router.reads == 4 + s.quiet_samples
+
+
+def test_old_entries_expiring_count_as_quiet():
+    router = FakeRouter([900, 700, 500])
+    s = settler(router)
+    s.wait()
+    assert router.reads == 1 + s.quiet_samples